@@ -5,4 +5,4 @@ prototype ipy tools.
 __author__ = 'Travis Harrison'
 __version__ = '0.5'
 __description__ = 'iPython Tools for Qiime-Matr-QC'
-__all__ = ["analysis","qc","ipyTools","flotplot","retina","metagenome","project","collection"]
+__all__ = ["analysis","qc","ipyTools","flotplot","retina","metagenome","project","collection","httppool","respcache","hierarchy","preprocessing","cluster","rarefy","diversity","fpcache","ordination","significance","matcache","biomhdf5","annotindex","selection"]
@@ -1,8 +1,16 @@
 #!/usr/bin/env python
 
 import math, urllib, sys, os, hashlib, traceback
-import rpy2.robjects as ro
+import matcache, biomhdf5
+import numpy as np
 from metagenome import Metagenome
+from preprocessing import preprocess_stats, extend_preprocessed
+from cluster import dendrograms, cached_distance
+import cluster, diversity, selection
+from ordination import pcoa
+from significance import group_test
+from rarefy import rarefaction_curve
+from diversity import INDICES, alpha_indices
 from ipyTools import *
 from collections import defaultdict
 from datetime import datetime
@@ -12,8 +20,16 @@ class AnalysisSet(object):
         - Creates an Analysis object for each taxonimic level and functional level
         - allows barchart and heatmap navigation through hierarchies (drilldowns)
         - caches data locally for fast re-analysis
+        - fetches levels concurrently with a bounded thread pool (workers=N)
+        - rollup=True: only fetches the leaf level (species, function) abundance,
+          coarser level abundance is summed locally from its row lineages.
+          off by default, rolled up values may not match the api: the api counts
+          each level on its own, summed leaf counts differ for reads annotated
+          to several leaves, and leaves without lineage are dropped
+        - add_metagenomes() fetches only the new metagenomes and merges them in
+        - self.errors : first load failure per level
     """
-    def __init__(self, ids=[], auth=None, method='WGS', function_source='Subsystems', all_values=False, cache=None, def_name=None):
+    def __init__(self, ids=[], auth=None, method='WGS', function_source='Subsystems', all_values=False, cache=None, def_name=None, workers=1, rollup=False):
         self.method  = method
         self._auth   = auth
         self.all_mgs = ids
@@ -35,10 +51,10 @@ class AnalysisSet(object):
         if cache and os.path.isdir(Ipy.NB_DIR+'/'+cache):
             biom_dir = Ipy.NB_DIR+'/'+cache
             sys.stdout.write("analysis-set '%s' loading from dir %s\n"%(self.defined_name, biom_dir))
-            self._get_analysis_set(tax_source=tax_source, all_values=all_values, biom_dir=biom_dir)
+            self._get_analysis_set(tax_source=tax_source, all_values=all_values, biom_dir=biom_dir, workers=workers, rollup=rollup)
         else:
             sys.stdout.write("analysis-set '%s' loading through api\n"%self.defined_name)
-            self._get_analysis_set(tax_source=tax_source, all_values=all_values)
+            self._get_analysis_set(tax_source=tax_source, all_values=all_values, workers=workers, rollup=rollup)
     
     def set_display_mgs(self, ids=[]):
         if (not ids) or (len(ids) == 0):
@@ -47,32 +63,102 @@ class AnalysisSet(object):
         else:
             self.display_mgs = ids
     
-    def _get_analysis_set(self, tax_source='M5NR', all_values=False, biom_dir=None):
-        # get data
-        for tax in Ipy.TAX_SET:
-            values = {}
-            if all_values:
-                for val in Ipy.VALUES:
-                    values[val] = self._get_analysis(self.all_mgs, 'organism', tax, val, tax_source, biom_dir)
-            else:
-                values['abundance'] = self._get_analysis(self.all_mgs, 'organism', tax, 'abundance', tax_source, biom_dir)
-            setattr(self, tax, values)
+    def _get_analysis_set(self, tax_source='M5NR', all_values=False, biom_dir=None, workers=1, rollup=False):
+        # build list of matrices to fetch
+        values = Ipy.VALUES if all_values else ['abundance']
+        hierarchies = [ ('organism', Ipy.TAX_SET, tax_source) ]
         if self.method == 'WGS':
-            for ont in Ipy.ONT_SET:
-                values = {}
-                if all_values:
-                    for val in Ipy.VALUES:
-                        values[val] = self._get_analysis(self.all_mgs, 'function', ont, val, self.function_source, biom_dir)
-                else:
-                    values['abundance'] = self._get_analysis(self.all_mgs, 'function', ont, 'abundance', self.function_source, biom_dir)
-                setattr(self, ont, values)
+            hierarchies.append( ('function', Ipy.ONT_SET, self.function_source) )
+        jobs = []
+        for annotation, hier_set, source in hierarchies:
+            for level in hier_set:
+                # abundance sums of coarser levels are rolled up from the leaf level
+                jobs.extend( [ (annotation, level, x, source) for x in values if not (rollup and (x == 'abundance') and (level != hier_set[-1])) ] )
+        # kept for add_metagenomes()
+        self._load_args = { 'jobs': jobs, 'hierarchies': hierarchies, 'biom_dir': biom_dir, 'rollup': rollup }
+        # fetch bioms with thread pool, network bound only
+        results = pool_map(lambda x: self._get_biom(self.all_mgs, x[0], x[1], x[2], x[3], biom_dir), jobs, workers=workers)
+        # build analysis objects in order, R is not thread safe
+        levels = {}
+        self.errors = {}
+        for job, res in zip(jobs, results):
+            annotation, level, result_type, source = job
+            biom, error = res
+            if level not in levels:
+                levels[level] = {}
+            if (error is None) and (not biom):
+                error = "no data returned"
+            if error is not None:
+                if level not in self.errors:
+                    self.errors[level] = "%s (%s): %s"%(level, result_type, error)
+                    sys.stderr.write("Error loading %s\n"%self.errors[level])
+                levels[level][result_type] = None
+                continue
+            sub_def_name = self.defined_name+'.'+level+"['"+result_type+"']"
+            levels[level][result_type] = Analysis(biom=biom, auth=self._auth, def_name=sub_def_name)
+        if rollup:
+            for annotation, hier_set, source in hierarchies:
+                leaf = levels[hier_set[-1]]['abundance']
+                for level in hier_set[:-1]:
+                    if level not in levels:
+                        levels[level] = {}
+                    biom = rollup_biom(leaf.biom, level, typed=True) if leaf is not None else None
+                    if not biom:
+                        if level not in self.errors:
+                            self.errors[level] = "%s (abundance): no rollup from %s"%(level, hier_set[-1])
+                            sys.stderr.write("Error loading %s\n"%self.errors[level])
+                        levels[level]['abundance'] = None
+                        continue
+                    sub_def_name = self.defined_name+'.'+level+"['abundance']"
+                    levels[level]['abundance'] = Analysis(biom=biom, auth=self._auth, def_name=sub_def_name)
+        for level, values in levels.iteritems():
+            setattr(self, level, values)
+
+    def add_metagenomes(self, ids, workers=1):
+        """add metagenomes to the set: only matrices of the new ids are fetched (per level, as the set was
+        loaded), their columns are merged into the existing Analysis objects, see Analysis.add_columns()"""
+        new_mgs = [ x for x in ids if x not in self.all_mgs ]
+        if len(new_mgs) == 0:
+            sys.stdout.write("no new metagenomes for analysis-set '%s'\n"%self.defined_name)
+            return
+        args = self._load_args
+        # a cached set has no files for the new ids, they are fetched and saved to its dir
+        results = pool_map(lambda x: self._get_biom(new_mgs, x[0], x[1], x[2], x[3], args['biom_dir'], fetch=True), args['jobs'], workers=workers)
+        added = {}
+        for job, res in zip(args['jobs'], results):
+            annotation, level, result_type, source = job
+            biom, error = res
+            if (error is None) and (not biom):
+                error = "no data returned"
+            if error is not None:
+                sys.stderr.write("Error adding to %s (%s): %s\n"%(level, result_type, error))
+                continue
+            added[(level, result_type)] = biom
+            self._add_columns(level, result_type, biom)
+        if args['rollup']:
+            for annotation, hier_set, source in args['hierarchies']:
+                leaf = added.get((hier_set[-1], 'abundance'))
+                if not leaf:
+                    continue
+                for level in hier_set[:-1]:
+                    self._add_columns(level, 'abundance', rollup_biom(leaf, level, typed=True))
+        if self.display_mgs is self.all_mgs:
+            self.display_mgs = self.all_mgs + new_mgs
+        self.all_mgs = self.all_mgs + new_mgs
+
+    def _add_columns(self, level, result_type, biom):
+        analysis = getattr(self, level, {}).get(result_type)
+        if analysis is None:
+            sys.stderr.write("Error adding to %s (%s): level not loaded\n"%(level, result_type))
+        elif biom:
+            analysis.add_columns(biom)
 
-    def _get_analysis(self, ids, annotation, level, result_type, source, biom_dir):
+    def _get_biom(self, ids, annotation, level, result_type, source, biom_dir, fetch=False):
+        # fetch: load through api when biom_dir has no file, and save it there
         # this needs to be created same way as matrix api builds it
         matrix_id = "_".join(sorted(ids))+"_"+"_".join([annotation, level, source, result_type])
         matrix_id += "_%d_%d_%d"%(Ipy.MATRIX['e_val'], Ipy.MATRIX['ident'], Ipy.MATRIX['alen'])
         matrix_md5 = hashlib.md5(matrix_id).hexdigest()
-        sub_def_name = self.defined_name+'.'+level+"['"+result_type+"']"
         # load from biom_dir
         if biom_dir:
             md5_file = biom_dir+'/'+matrix_md5+'.biom'
@@ -80,28 +166,45 @@ class AnalysisSet(object):
             if os.path.isfile(md5_file):
                 if Ipy.DEBUG:
                     sys.stdout.write("loading %s.biom (%s) from dir %s ... \n"%(matrix_md5, matrix_id, biom_dir))
-                return Analysis(bfile=md5_file, auth=self._auth, def_name=sub_def_name)
+                return self._load_biom_file(md5_file)
             elif os.path.isfile(id_file):
                 if Ipy.DEBUG:
                     sys.stdout.write("loading %s.biom from dir %s ... \n"%(matrix_id, biom_dir))
-                return Analysis(bfile=id_file, auth=self._auth, def_name=sub_def_name)
-            else:
-                sys.stderr.write("no biom file for %s in dir %s\n"%(matrix_id, biom_dir))
-                return None
+                return self._load_biom_file(id_file)
+            elif not fetch:
+                raise IOError("no biom file for %s in dir %s"%(matrix_id, biom_dir))
         # load through api
-        else:
+        if Ipy.DEBUG:
+            sys.stdout.write("loading %s through api ... \n"%matrix_id)
+        keyArgs = dict(Ipy.MATRIX)
+        keyArgs['annotation'] = annotation
+        keyArgs['level'] = level
+        keyArgs['result_type'] = result_type
+        keyArgs['source'] = source
+        keyArgs['auth'] = self._auth
+        # api errors reach pool_map, so they are recorded for the level
+        keyArgs['raise_errors'] = True
+        biom = get_matrix(ids, **keyArgs)
+        if biom_dir and biom:
+            try:
+                json.dump(biom, open(md5_file, 'w'))
+            except IOError, e:
+                sys.stderr.write("Error saving %s to dir %s: %s\n"%(matrix_id, biom_dir, e))
+        return biom
+
+    def _load_biom_file(self, bfile):
+        # memory-mapped binary cache next to the biom file, written on first json load
+        biom = matcache.load(bfile)
+        if biom is not None:
+            return biom
+        biom = json.load(open(bfile, 'rU'))
+        biom['data'] = biom_matrix(biom)
+        try:
+            matcache.save(bfile, biom, biom['data'])
+        except (IOError, OSError), e:
             if Ipy.DEBUG:
-                sys.stdout.write("loading %s through api ... \n"%matrix_id)
-            keyArgs = Ipy.MATRIX
-            keyArgs['ids'] = ids
-            keyArgs['annotation'] = annotation
-            keyArgs['level'] = level
-            keyArgs['result_type'] = result_type
-            keyArgs['source'] = source
-            keyArgs['def_name'] = sub_def_name
-            if self._auth:
-                keyArgs['auth'] = self._auth
-            return Analysis(**keyArgs)
+                sys.stderr.write("unable to cache %s: %s\n"%(bfile, e))
+        return biom
 
     def boxplot(self, annot='organism', level='domain', parent=None, width=300, height=300, title="", normalize=1, col_name=True, show_data=False, arg_list=False):
         children = []
@@ -125,7 +228,7 @@ class AnalysisSet(object):
         to_plot = getattr(self, level)
         return to_plot['abundance'].boxplot(**keyArgs)
     
-    def barchart(self, annot='organism', level='domain', parent=None, width=800, height=0, title="", legend=True, normalize=1, col_name=True, row_full=False, show_data=False, arg_list=False):
+    def barchart(self, annot='organism', level='domain', parent=None, width=800, height=0, title="", legend=True, normalize=1, col_name=True, row_full=False, show_data=False, arg_list=False, top=None, top_by='abundance'):
         children = []
         if parent and (len(parent) > 0):
             for p in parent:
@@ -143,17 +246,19 @@ class AnalysisSet(object):
                     'col_name': col_name,
                     'row_full': row_full,
                     'show_data': show_data,
-                    'arg_list': arg_list }
+                    'arg_list': arg_list,
+                    'top': top,
+                    'top_by': top_by }
         next_level = child_level(level, htype=annot)
         if next_level:
-            click_opts = (self.defined_name, next_level, annot, normalize, width, height, title, self._bool(legend), self._bool(col_name), self._bool(row_full), self._bool(show_data))
-            keyArgs['onclick'] = "'%s.barchart(level=\"%s\", parent=[\"'+params['label']+'\"], annot=\"%s\", normalize=%d, width=%d, height=%d, title=\"%s\", legend=%s, col_name=%s, row_full=%s, show_data=%s)'"%click_opts
+            click_opts = (self.defined_name, next_level, annot, normalize, width, height, title, self._bool(legend), self._bool(col_name), self._bool(row_full), self._bool(show_data), top, top_by)
+            keyArgs['onclick'] = "'%s.barchart(level=\"%s\", parent=[\"'+params['label']+'\"], annot=\"%s\", normalize=%d, width=%d, height=%d, title=\"%s\", legend=%s, col_name=%s, row_full=%s, show_data=%s, top=%s, top_by=\"%s\")'"%click_opts
         if Ipy.DEBUG:
             print annot, level, next_level, keyArgs
         to_plot = getattr(self, level)
         return to_plot['abundance'].barchart(**keyArgs)
         
-    def heatmap(self, annot='organism', level='domain', parent=None, width=700, height=600, normalize=1, dist='bray-curtis', clust='ward', col_name=True, row_full=False, show_data=False, arg_list=False):
+    def heatmap(self, annot='organism', level='domain', parent=None, width=700, height=600, normalize=1, dist='bray-curtis', clust='ward', col_name=True, row_full=False, show_data=False, arg_list=False, top=None, top_by='abundance'):
         children = []
         if parent and (len(parent) > 0):
             for p in parent:
@@ -171,11 +276,13 @@ class AnalysisSet(object):
                     'row_full': row_full,
                     'show_data': show_data,
                     'arg_list': arg_list,
-                    'source': 'retina' }
+                    'source': 'retina',
+                    'top': top,
+                    'top_by': top_by }
         next_level = child_level(level, htype=annot)
         if next_level:
-            click_opts = (self.defined_name, next_level, annot, normalize, width, height, dist, clust, self._bool(col_name), self._bool(row_full), self._bool(show_data))
-            keyArgs['onclick'] = "'%s.heatmap(level=\"%s\", parent=\"'+sel_names+'\", annot=\"%s\", normalize=%d, width=%d, height=%d, dist=\"%s\", clust=\"%s\", col_name=%s, row_full=%s, show_data=%s)'"%click_opts
+            click_opts = (self.defined_name, next_level, annot, normalize, width, height, dist, clust, self._bool(col_name), self._bool(row_full), self._bool(show_data), top, top_by)
+            keyArgs['onclick'] = "'%s.heatmap(level=\"%s\", parent=\"'+sel_names+'\", annot=\"%s\", normalize=%d, width=%d, height=%d, dist=\"%s\", clust=\"%s\", col_name=%s, row_full=%s, show_data=%s, top=%s, top_by=\"%s\")'"%click_opts
         if Ipy.DEBUG:
             print annot, level, next_level, keyArgs
         to_plot = getattr(self, level)
@@ -208,11 +315,28 @@ class Analysis(object):
         self.id       : BIOM id
         self.numIDs   : BIOM column count
         self.numAnnot : BIOM row count
-        self.Dmatrix  : dense matrix of BIOM data
+        self.Smatrix  : sparse (scipy csr) matrix of BIOM data, None for dense BIOM
+        self.Dmatrix  : dense numpy matrix (rows x cols) of BIOM data, dtype from matrix_element_type
         self.Rmatrix  : R-format dense matrix
-        self.NDmatrix : normalized dense matrix
+        self.NDmatrix : normalized dense numpy matrix (float)
         self.NRmatrix : normalized R-format dense matrix
         
+        BIOM data is held once, as the same array as self.Smatrix or self.Dmatrix.
+        self.biom is a copy of a given BIOM, its "data" is the typed matrix, not lists:
+        write it with self.dump() or json.dumps(self.biom, default=json_default).
+        Sparse data is not densified until self.Dmatrix is used, self.sub_matrix(),
+        self.column() and self.row() only densify the requested rows and columns.
+        Normalized and R matrices are built on first use.
+        Row and column ids, column names and row leaf names are resolved through
+        dict indexes, rebuilt when self.biom rows or columns change.
+        Annotation searches (find_annotation, find_rows) use an AnnotationIndex of the rows.
+        
+        Column groups:
+            self.merge_columns() : Analysis of columns merged by group (sum, mean or median)
+        Row selection:
+            self.top_rows()    : ids of top rows by abundance, variance, prevalence or cv
+            self.filter_rows() : Analysis of rows passing count / prevalence filters
+        
         Visualizations:
             self.dump()     : produce file or string of BIOM or tab-deliminated matrix
             self.boxplot()  : boxplot display
@@ -220,7 +344,7 @@ class Analysis(object):
             self.pco()      : pco plot of metagenomes
             self.heatmap()  : dendogram of metagenomes / annotations
     """
-    def __init__(self, ids=[], annotation=None, level=None, result_type=None, source=None, e_val=None, ident=None, alen=None, filters=[], filter_source=None, biom=None, bfile=None, auth=None, def_name=None):
+    def __init__(self, ids=[], annotation=None, level=None, result_type=None, source=None, e_val=None, ident=None, alen=None, filters=[], filter_source=None, biom=None, bfile=None, auth=None, def_name=None, rows=None, cols=None):
         self._auth = auth
         # hack to get variable name
         if def_name == None:
@@ -230,7 +354,15 @@ class Analysis(object):
         if (biom is None) and (bfile is None):
             self.biom = self._get_matrix(ids, annotation, level, result_type, source, e_val, ident, alen, filters, filter_source)
         elif biom and isinstance(biom, dict):
-            self.biom = biom
+            # own copy, the data is replaced with a typed matrix
+            self.biom = dict(biom)
+        elif bfile and biomhdf5.is_hdf5(bfile):
+            # only reads rows / cols subset of the table
+            try:
+                self.biom = biomhdf5.read(bfile, rows=rows, cols=cols)
+            except (IOError, KeyError), e:
+                sys.stderr.write("Error reading %s: %s\n"%(bfile, e))
+                self.biom = None
         elif bfile and os.path.isfile(bfile):
             try:
                 bhdl = open(bfile, 'rU')
@@ -240,6 +372,8 @@ class Analysis(object):
                 self.biom = None
         else:
             self.biom = None
+        self.base = None       # Analysis this is a row filtered view of, see filter_rows()
+        self.row_index = None  # positions of rows in self.base
         self._init_matrix()
 
     def _init_matrix(self):
@@ -248,38 +382,44 @@ class Analysis(object):
         self.result_type = self.biom['matrix_element_value'] if self.biom else ""
         self.numIDs = self.biom['shape'][1] if self.biom else 0
         self.numAnnot = self.biom['shape'][0] if self.biom else 0
-        self.Dmatrix  = self._dense_matrix()  # count dense matrix
-        self.Rmatrix  = pyMatrix_to_rMatrix(self.Dmatrix, self.numAnnot, self.numIDs) # R count matrix object
-        self.NDmatrix = None  # normalized dense matrix
-        self.NRmatrix = None  # R normalized matrix object
-        if self.result_type == 'abundance':
-            self._normalize_matrix() # only normalize abundance counts
-        self.alpha_diversity = None
-        self.rarefaction     = None
+        self.Smatrix   = None  # sparse count matrix
+        self._dmatrix  = None  # dense count matrix
+        self._rmatrix  = None  # R count matrix object
+        self._ndmatrix = None  # normalized dense matrix
+        self._nrmatrix = None  # R normalized matrix object
+        self._normalized = (self.result_type != 'abundance') # only normalize abundance counts
+        self._clear_indexes()
+        self._norm_stats = None  # preprocess_stats() values of self._ndmatrix
+        self._load_matrix()
+        self._rarefaction    = None
     
+    @property
+    def Dmatrix(self):
+        if self._dmatrix is None:
+            self._dmatrix = self.Smatrix.toarray()
+        return self._dmatrix
+
+    @property
+    def Rmatrix(self):
+        if self._rmatrix is None:
+            self._rmatrix = pyMatrix_to_rMatrix(self.Dmatrix, self.numAnnot, self.numIDs)
+        return self._rmatrix
+
+    @property
+    def NDmatrix(self):
+        if not self._normalized:
+            self._normalized = True
+            self._normalize_matrix()
+        return self._ndmatrix
+
+    @property
+    def NRmatrix(self):
+        if (self._nrmatrix is None) and (self.NDmatrix is not None):
+            self._nrmatrix = pyMatrix_to_rMatrix(self.NDmatrix, self.numAnnot, self.numIDs, normalize=1)
+        return self._nrmatrix
+
     def _get_matrix(self, ids, annotation, level, result_type, source, e_val, ident, alen, filters, filter_source):
-        params = map(lambda x: ('id', x), ids)
-        if not annotation:
-            annotation = Ipy.MATRIX['annotation']
-        if level:
-            params.append(('group_level', level))
-        if result_type:
-            params.append(('result_type', result_type))
-        if source:
-            params.append(('source', source))
-        if e_val:
-            params.append(('evalue', str(e_val)))
-        if ident:
-            params.append(('identity', str(ident)))
-        if alen:
-            params.append(('length', str(alen)))
-        if len(filters) > 0:
-            params.extend( map(lambda x: ('filter', x), filters) )
-            if filter_source:
-                params.append(('filter_source', filter_source))
-        if self._auth:
-            params.append(('auth', self._auth))
-        return obj_from_url( Ipy.API_URL+'matrix/'+annotation+'?'+urllib.urlencode(params, True) )
+        return get_matrix(ids, annotation, level, result_type, source, e_val, ident, alen, filters, filter_source, auth=self._auth)
 
     def _get_type(self, biom):
         hier = ''
@@ -289,125 +429,393 @@ class Analysis(object):
             hier = 'ontology'
         return hier
 
-    def find_annotation(self, text, show_id=True):
+    def add_columns(self, biom):
+        """merge the columns (metagenomes) of biom into this matrix in place, ids already present are skipped:
+        existing rows and columns keep their positions, new rows are appended.
+        normalized values, diversity indices, rarefaction curves and count distances between samples
+        are carried over, only the added columns are computed.
+        returns list of added column ids"""
+        if not (biom and biom.get('columns')):
+            return []
         if not self.biom:
+            self.biom = dict(biom)
+            self._init_matrix()
+            return self.ids()
+        if (biom['type'] != self.biom['type']) or (biom['matrix_element_value'] != self.biom['matrix_element_value']):
+            sys.stderr.write("Error: can not add %s (%s) columns to %s\n"%(biom['type'], biom['matrix_element_value'], self.id))
             return []
-        str_re = re.compile(text, re.IGNORECASE)
-        annot = set()        
-        for r in self.biom['rows']:
-            if r['metadata'] and self.hierarchy and (self.hierarchy in r['metadata']) and str_re.search(r['metadata'][self.hierarchy][-1]):
-                annot.add( r['id'] if show_id else r['metadata'][self.hierarchy][-1] )
-            elif str_re.search(r['id']):
-                annot.add(r['id'])
-        return list(annot)
-
-    def sub_matrix(self, normalize=0, cols=None, rows=None):
-        all_annot = self.annotations()
-        all_mgids = self.ids()
-        matrix = self.NDmatrix if normalize and self.NDmatrix else self.Dmatrix
-        # validate rows / get indexes
-        aIndex = []
-        if rows and (len(rows) > 0):
-            aIndex = range(len(all_annot))
+        imaps  = self._index_maps()
+        cIndex = [ j for j, c in enumerate(biom['columns']) if c['id'] not in imaps['col'] ]
+        if len(cIndex) == 0:
+            return []
+        # merged row positions of biom rows, unknown rows appended
+        rows = list(self.biom['rows'])
+        rpos = dict(imaps['row'])
+        rIndex = []
+        for r in biom['rows']:
+            if r['id'] not in rpos:
+                rpos[r['id']] = len(rows)
+                rows.append(r)
+            rIndex.append(rpos[r['id']])
+        old   = self._matrix(0)
+        added = biom_matrix(biom)[:,cIndex]
+        etype = 'int' if (self.biom['matrix_element_type'] == 'int') and (biom['matrix_element_type'] == 'int') else 'float'
+        dtype = np.int64 if etype == 'int' else np.float64
+        shape = (len(rows), self.numIDs + len(cIndex))
+        if self.biom['matrix_type'] == 'sparse':
+            ocoo, acoo = old.tocoo(), sp.coo_matrix(added)
+            merged = sp.csr_matrix(( np.concatenate([ocoo.data, acoo.data]).astype(dtype),
+                                     ( np.concatenate([ocoo.row, np.asarray(rIndex, dtype=int)[acoo.row]]),
+                                       np.concatenate([ocoo.col, acoo.col + self.numIDs]) ) ), shape=shape)
         else:
-            for r in rows:
-                try:
-                    a = all_annot.index(r)
-                except (ValueError, AttributeError):
-                    continue
-                aIndex.append(a)
-        # validate cols / get indexes
-        mgids  = []
-        mIndex = []
-        if cols and (len(cols) > 0):
-            mgids  = all_mgids
-            mIndex = range(len(all_mgids))
+            merged = np.zeros(shape, dtype=dtype)
+            merged[:self.numAnnot,:self.numIDs] = old
+            merged[np.asarray(rIndex, dtype=int),self.numIDs:] = to_dense(added)
+        # carry over results of existing columns
+        norm = None
+        if self._normalized and (self._ndmatrix is not None) and (self._norm_stats is not None):
+            norm = extend_preprocessed(self._ndmatrix, self._norm_stats, merged[:,self.numIDs:])
+        cluster.extend_cache(old.T, merged.T)
+        diversity.extend_cache(old, merged)
+        rarefaction = self._rarefaction
+        new_cols = [ biom['columns'][j] for j in cIndex ]
+        self.biom['id'] = self.biom['id']+'_'+biom['id']
+        self.biom['rows'] = rows
+        self.biom['columns'] = self.biom['columns'] + new_cols
+        self._clear_indexes()
+        self.biom['matrix_element_type'] = etype
+        self.biom['data']  = merged
+        self.biom['shape'] = list(shape)
+        self._init_matrix()
+        self._rarefaction = rarefaction
+        if norm is not None:
+            self._ndmatrix, self._norm_stats = norm
+            self._normalized = True
+        return map(lambda x: x['id'], new_cols)
+
+    def merge_columns(self, groups, method='sum', field=None, def_name=None):
+        """new Analysis with columns merged into groups, one vectorized reduction (sum, mean or median) per matrix,
+        rows are shared with this Analysis biom, merged columns are followed by the ungrouped ones
+            groups: dict of group name -> list of column ids,
+                    dict of column id -> group label (e.g. Collection.metadata_groups),
+                    or a Collection to group by its metadata field"""
+        if not self.biom:
+            return None
+        if def_name == None:
+            (filename,line_number,function_name,text)=traceback.extract_stack()[-2]
+            def_name = text[:text.find('=')].strip()
+        if hasattr(groups, 'metadata_groups'):
+            groups = groups.metadata_groups(field)
+        if groups and (not all(isinstance(x, (list, tuple, set)) for x in groups.itervalues())):
+            # column id -> label, to label -> column ids in column order
+            merge_set = defaultdict(list)
+            for aID in self.ids():
+                if aID in groups:
+                    merge_set[groups[aID]].append(aID)
+            groups = dict(merge_set)
+        biom = merge_cols(self.biom, groups, method=method, typed=True)
+        if biom is None:
+            return None
+        return Analysis(biom=biom, auth=self._auth, def_name=def_name)
+
+    def top_rows(self, k, by='abundance', normalize=0, rows=None, cols=None):
+        """ids of the k top rows (of rows, all if not given) over cols, highest first, see selection.SELECT_BY:
+            abundance, prevalence : sum and count of non-zero counts
+            variance, cv          : variance and coefficient of variation of the values, normalized if normalize
+        ranked by partial sort, without densifying sparse matrices"""
+        if not self.biom:
+            return None
+        if by not in selection.SELECT_BY:
+            sys.stderr.write("Error: invalid row selection '%s', use one of: %s\n"%(by, ", ".join(selection.SELECT_BY)))
+            return None
+        rIndex = self._row_indexes(rows)
+        cIndex = self._col_indexes(cols)
+        matrix = self._matrix(normalize if by in ('variance', 'cv') else 0)
+        if (len(rIndex) < self.numAnnot) or (len(cIndex) < self.numIDs):
+            matrix = matrix[rIndex][:,cIndex] if sp.issparse(matrix) else matrix[np.ix_(rIndex, cIndex)]
+        return map(lambda i: self.biom['rows'][rIndex[i]]['id'], selection.top_rows(matrix, k, by))
+
+    def filter_rows(self, min_total=None, min_count=None, min_relative=None, min_samples=1, def_name=None):
+        """new Analysis of the rows that pass all given filters (see selection.filter_rows):
+            min_total    : total count over all samples
+            min_count    : count in at least min_samples samples
+            min_relative : relative abundance in at least min_samples samples
+        the result is a view of this Analysis: it shares the row and column entries of the biom, holds only
+        the kept rows of the matrix, and normalizes / clusters those on first use.
+        view.base is this Analysis and view.row_index the positions of its rows here, filters can be chained"""
+        if not self.biom:
+            return None
+        if def_name == None:
+            (filename,line_number,function_name,text)=traceback.extract_stack()[-2]
+            def_name = text[:text.find('=')].strip()
+        matrix = self._matrix(0)
+        index  = selection.filter_rows(matrix, min_total=min_total, min_count=min_count, min_relative=min_relative, min_samples=min_samples)
+        if len(index) == self.numAnnot:
+            data = matrix
         else:
-            for c in cols:
-                try:
-                    m = all_mgids.index(c)
-                except (ValueError, AttributeError):
-                    continue
-                mgids.append(all_mgids[m])
-                mIndex.append(m)
-        # build matrix
-        sub_matrix = []
-        for i in aIndex:
-            rdata = []
-            for j in mIndex:
-                rdata.append(matrix[i][j])
-            sub_matrix.append(rdata)
-        return sub_matrix
-
-    def dump(self, fname=None, fformat='biom', normalize=0, rows=None, cols=None, col_name=False, row_full=False):
+            data = matrix[index] if sp.issparse(matrix) else matrix[index,:]
+        biom = dict(self.biom)
+        biom['id']    = self.biom['id']+'_filtered'
+        biom['rows']  = [ self.biom['rows'][i] for i in index ]
+        biom['data']  = data
+        biom['shape'] = [ len(index), self.numIDs ]
+        view = Analysis(biom=biom, auth=self._auth, def_name=def_name)
+        view.base = self
+        view.row_index = index
+        if Ipy.DEBUG:
+            sys.stdout.write("%s: kept %d of %d rows\n"%(def_name, len(index), self.numAnnot))
+        return view
+
+    def find_annotation(self, text, show_id=True):
+        """row ids where text (regex, case-insensitive) matches the id or the hierarchy leaf name,
+        leaf names instead of ids for leaf matches if show_id=False"""
+        if not self.biom:
+            return []
+        index = self._annotation_index()
+        leaf  = index.search(text, fields=['leaf'])
+        rows  = np.union1d(leaf, index.search(text, fields=['id']))
+        leaf  = set(leaf.tolist())
+        annot = []
+        seen  = set()
+        for i in rows:
+            r = self.biom['rows'][i]
+            name = r['metadata'][self.hierarchy][-1] if (not show_id) and (i in leaf) else r['id']
+            if name not in seen:
+                annot.append(name)
+                seen.add(name)
+        return annot
+
+    def find_rows(self, text, lineage=False, token=False):
+        """sorted array of row indexes where text matches the id or the hierarchy leaf name (or any name
+        of the lineage if lineage=True), for use with sub_block(), sub_matrix() row positions:
+            token=False : text is a case-insensitive regex, plain, ^prefix and suffix$ text are answered from the index
+            token=True  : rows containing every word of text"""
+        if not self.biom:
+            return np.zeros(0, dtype=int)
+        fields = ['id', 'leaf', 'lineage'] if lineage else ['id', 'leaf']
+        index  = self._annotation_index()
+        return index.token(text, fields=fields) if token else index.search(text, fields=fields)
+
+    def sub_matrix(self, normalize=0, cols=None, rows=None, as_array=False):
+        """returns matrix of given row ids and column ids, default is all
+        invalid ids are skipped, list of lists unless as_array is true"""
+        aIndex = self._row_indexes(rows)
+        mIndex = self._col_indexes(cols)
+        sub_matrix = sub_block(self._matrix(normalize), aIndex, mIndex)
+        return sub_matrix if as_array else sub_matrix.tolist()
+
+    def column(self, cid, normalize=0):
+        """returns numpy vector of column for id"""
+        index = self._col_indexes([cid])
+        return sub_block(self._matrix(normalize), np.arange(self.numAnnot), index)[:,0] if len(index) else None
+
+    def row(self, rid, normalize=0):
+        """returns numpy vector of row for id"""
+        index = self._row_indexes([rid])
+        return sub_block(self._matrix(normalize), index, np.arange(self.numIDs))[0] if len(index) else None
+
+    def _row_label(self, index, row_full=False):
+        row = self.biom['rows'][index]
+        if row_full and self.hierarchy and row['metadata'] and (self.hierarchy in row['metadata']):
+            return ";".join( map(lambda x: 'none' if x is None else x, row['metadata'][self.hierarchy]) )
+        return row['id']
+
+    def _matrix(self, normalize=0):
+        """normalized matrix if asked and available, else count matrix (sparse if BIOM is sparse)"""
+        if normalize and (self.NDmatrix is not None):
+            return self.NDmatrix
+        return self.Smatrix if self.Smatrix is not None else self.Dmatrix
+
+    def _clear_indexes(self):
+        """drop row / column lookups, whenever biom rows or columns are replaced"""
+        self._imaps  = None  # id / name -> position maps of rows and columns
+        self._aindex = None  # AnnotationIndex of rows
+
+    def _index_maps(self):
+        """dicts of row id, row leaf name, column id and column name -> position"""
+        if not self.biom:
+            return {'row': {}, 'leaf': {}, 'col': {}, 'name': {}}
+        if self._imaps is None:
+            maps = { 'row': {}, 'leaf': {}, 'col': {}, 'name': {} }
+            for i, r in enumerate(self.biom['rows']):
+                maps['row'][r['id']] = i
+                if r['metadata'] and self.hierarchy and (self.hierarchy in r['metadata']):
+                    maps['leaf'][r['metadata'][self.hierarchy][-1]] = i
+            for j, c in enumerate(self.biom['columns']):
+                maps['col'][c['id']] = j
+                if 'name' in c:
+                    maps['name'][c['name']] = j
+            self._imaps = maps
+        return self._imaps
+
+    def _annotation_index(self):
+        """AnnotationIndex of biom rows"""
+        if self._aindex is None:
+            self._aindex = AnnotationIndex(self.biom['rows'] if self.biom else [], self.hierarchy)
+        return self._aindex
+
+    def _row_indexes(self, rows):
+        """positions of row ids (or leaf names), all rows if none given, unknown ids are skipped"""
+        maps = self._index_maps()
+        return self._positions(maps['row'], maps['leaf'], rows, len(self.biom['rows']) if self.biom else 0)
+
+    def _col_indexes(self, cols):
+        """positions of column ids (or names), all columns if none given, unknown ids are skipped"""
+        maps = self._index_maps()
+        return self._positions(maps['col'], maps['name'], cols, len(self.biom['columns']) if self.biom else 0)
+
+    def _positions(self, imap, alt, subset, size):
+        if not subset:
+            return np.arange(size)
+        return np.array([ imap[x] if x in imap else alt[x] for x in subset if (x in imap) or (x in alt) ], dtype=int)
+
+    def dump(self, fname=None, fformat='biom', normalize=0, rows=None, cols=None, col_name=False, row_full=False, fhdl=None, top=None, top_by='abundance'):
         """Function for outputing the analysis object to flatfile or text string
             Inputs:
                 fname:     name of file to output too, if undefined returns string
-                fformat:   format of output, options are 'biom' or 'tab', default is 'biom'
+                fhdl:      open file handle to write output to, instead of fname
+                fformat:   format of output, options are 'biom', 'hdf5' (BIOM 2.1, requires fname and h5py) or 'tab', default is 'biom'
                 normalize: boolean - if true output normalized abundance values, default is false
                 rows:      if list of row ids is passed will only output matrix of those rows, else output all rows
                 cols:      if list of column ids is passed will only output matrix of those columns, else output all columns
                 metadata:  boolean - for 'tab' output, print last metadata of hierarchy for rows instaed of row id, default false
                 col_name:  boolean - for 'tab' output, print column name instead of column id, default is false
+                top:       for 'tab' output, only output the top rows of rows ranked by top_by, see top_rows()
+                rows, cols, normalize and top apply to 'tab' and 'hdf5' output, 'biom' output is the full matrix
             Output available:
                 1. biom file
                 2. biom string
-                3. tab-deliminated file
-                4. tab-deliminated string
+                3. biom hdf5 file
+                4. tab-deliminated file
+                5. tab-deliminated string
+            Output is written as it is produced, see dump_iter()
         """
-        output = ""
         if not self.biom:
             sys.stderr.write("Error dumping %s, no data\n"%self.id)
             return
+        if fformat == 'hdf5':
+            if not fname:
+                sys.stderr.write("Error dumping %s, hdf5 output requires a file name\n"%self.id)
+                return None
+            selection = self._dump_selection(normalize, rows, cols, top, top_by)
+            if selection is None:
+                return None
+            rows, rIndex, cols, cIndex = selection
+            matrix = self._matrix(normalize)
+            biom = dict(self.biom)
+            if (rIndex != range(self.numAnnot)) or (cIndex != range(self.numIDs)):
+                matrix = matrix[rIndex][:,cIndex] if sp.issparse(matrix) else matrix[np.ix_(rIndex, cIndex)]
+                biom['rows'] = [ self.biom['rows'][i] for i in rIndex ]
+                biom['columns'] = [ self.biom['columns'][j] for j in cIndex ]
+                biom['shape'] = [ len(rIndex), len(cIndex) ]
+            if normalize and (matrix.dtype.kind == 'f'):
+                biom['matrix_element_type'] = 'float'
+            biomhdf5.write(fname, biom, matrix)
+            return None
+        chunks = self.dump_iter(fformat=fformat, normalize=normalize, rows=rows, cols=cols, col_name=col_name, row_full=row_full, top=top, top_by=top_by)
+        if chunks is None:
+            return None
+        if fhdl:
+            for chunk in chunks:
+                fhdl.write(chunk)
+        elif fname:
+            ohdl = open(fname, 'w')
+            for chunk in chunks:
+                ohdl.write(chunk)
+            ohdl.close()
+        else:
+            return "".join(chunks)
+
+    def dump_iter(self, fformat='biom', normalize=0, rows=None, cols=None, col_name=False, row_full=False, block=1000, top=None, top_by='abundance'):
+        """generator of dump() output text, 'tab' output is produced block rows at a time
+        returns None if rows or cols are not in matrix"""
+        if not self.biom:
+            return None
         if fformat == 'biom':
-            # biom dump
-            output = json.dumps(self.biom)
+            return self._iter_biom(block)
+        # tab deleminted dump / option for sub-dump
+        selection = self._dump_selection(normalize, rows, cols, top, top_by)
+        if selection is None:
+            return None
+        rows, rIndex, cols, cIndex = selection
+        return self._iter_tab(self._matrix(normalize), rows, rIndex, cols, cIndex, col_name, row_full, block)
+
+    def _dump_selection(self, normalize, rows, cols, top, top_by):
+        # row ids, row indexes, column ids and column indexes to dump, None if not in matrix
+        # default is all ids
+        if (not cols) or (len(cols) == 0):
+            cols = self.ids()
+        if (not rows) or (len(rows) == 0):
+            rows = self.annotations()
+        # force rows to be row ids
         else:
-            # tab deleminted dump / option for sub-dump
-            all_annot = self.annotations()
-            all_mgids = self.ids()
-            matrix = self.NDmatrix if normalize and self.NDmatrix else self.Dmatrix
-            # default is all ids
-            if (not cols) or (len(cols) == 0):
-                cols = self.ids()
-            if (not rows) or (len(rows) == 0):
-                rows = all_annot
-            # force rows to be row ids
+            rows = self.force_row_ids(rows)
+        if top:
+            rows = self.top_rows(top, by=top_by, normalize=normalize, rows=rows, cols=cols)
+            if rows is None:
+                return None
+        cIndex = self._dump_indexes(self._index_maps()['col'], cols, 'metagenomes')
+        rIndex = self._dump_indexes(self._index_maps()['row'], rows, 'annotations')
+        if (cIndex is None) or (rIndex is None):
+            return None
+        return rows, rIndex, cols, cIndex
+
+    def _dump_indexes(self, imap, subset, name):
+        for x in subset:
+            if x not in imap:
+                sys.stderr.write("Error: '%s' is not in %s of %s\n"%(x, name, self.id))
+                return None
+        return [ imap[x] for x in subset ]
+
+    def _iter_biom(self, block):
+        # large lists are encoded block items at a time, with the C json encoder
+        yield "{"
+        for n, key in enumerate(self.biom.iterkeys()):
+            value = self.biom[key]
+            if key == 'data':
+                blocks = self._biom_data_blocks(block)
+            elif key in ('rows', 'columns'):
+                blocks = ( value[b:b+block] for b in xrange(0, len(value), block) )
             else:
-                rows = self.force_row_ids(rows)
-            # set header - write id or name
-            output = ''
-            for c in cols:
-                try:
-                    j = all_mgids.index(c)
-                except:
-                    sys.stderr.write("Error: '%s' is not in metagenomes of %s"%(c, self.id))
-                    return None
-                output += "\t" + str(c if not col_name else self.biom['columns'][j]['name'])
-            output += "\n"
-            # print matrix
-            for r in rows:
-                try:
-                    i = all_annot.index(r)
-                except:
-                    sys.stderr.write("Error: '%s' is not in annotations of %s"%(r, self.id))
-                    return None
-                if row_full and self.hierarchy and self.biom['rows'][i]['metadata'] and (self.hierarchy in self.biom['rows'][i]['metadata']):
-                    output += ";".join( map(lambda x: 'none' if x is None else x, self.biom['rows'][i]['metadata'][self.hierarchy]) )
-                else:
-                    output += r
-                for c in cols:
-                    try:
-                        j = all_mgids.index(c)
-                    except:
-                        sys.stderr.write("Error: '%s' is not in metagenomes of %s"%(c, self.id))
-                        return None
-                    output += "\t"+str(matrix[i][j])
-                output += "\n"
-        if fname:
-            open(fname, 'w').write(output)
+                yield "%s%s: %s"%(", " if n else "", json.dumps(key), json.dumps(value, default=json_default))
+                continue
+            yield "%s%s: ["%(", " if n else "", json.dumps(key))
+            first = True
+            for items in blocks:
+                if len(items) == 0:
+                    continue
+                yield ("" if first else ", ")+json.dumps(items, default=json_default)[1:-1]
+                first = False
+            yield "]"
+        yield "}"
+
+    def _biom_data_blocks(self, block):
+        # biom data in blocks of dense rows or sparse [row, col, value] items,
+        # sparse items are built from slices of the coo arrays, one block at a time
+        data = self.biom['data']
+        if sp.issparse(data):
+            coo = data.tocoo()
+            for b in xrange(0, coo.nnz, block):
+                yield zip(coo.row[b:b+block].tolist(), coo.col[b:b+block].tolist(), coo.data[b:b+block].tolist())
         else:
-            return output
+            for b in xrange(0, len(data), block):
+                yield data[b:b+block]
+
+    def _iter_tab(self, matrix, rows, rIndex, cols, cIndex, col_name, row_full, block):
+        # set header - write id or name
+        yield "".join( map(lambda (c, j): "\t"+str(c if not col_name else self.biom['columns'][j]['name']), zip(cols, cIndex)) )+"\n"
+        # print matrix
+        for b in xrange(0, len(rIndex), block):
+            values = sub_block(matrix, rIndex[b:b+block], cIndex)
+            lines  = []
+            for r, i, vals in zip(rows[b:b+block], rIndex[b:b+block], values):
+                rmeta = self.biom['rows'][i]['metadata']
+                if row_full and self.hierarchy and rmeta and (self.hierarchy in rmeta):
+                    label = ";".join( map(lambda x: 'none' if x is None else x, rmeta[self.hierarchy]) )
+                else:
+                    label = r
+                lines.append( label+"".join(map(lambda v: "\t"+str(v), vals))+"\n" )
+            yield "".join(lines)
 
     def ids(self):
         if not self.biom:
@@ -438,22 +846,17 @@ class Analysis(object):
 
     def force_row_ids(self, rows):
         """returns input list with last hierarchal metadata name replaced with id"""
-        ann = []
         if not self.hierarchy:
             return rows
-        rmap = dict([ (y['metadata'][self.hierarchy][-1], y['id']) for y in filter(lambda x: x['metadata'] and (self.hierarchy in x['metadata']), self.biom['rows']) ])
-        for i, r in enumerate(rows):
-            ann.append( rmap[r] if r in rmap else r )
-        return ann
+        leaf = self._index_maps()['leaf']
+        return map(lambda r: self.biom['rows'][leaf[r]]['id'] if r in leaf else r, rows)
 
     def get_id_object(self, aid):
         if not self.biom:
             return None
-        try:
-            items = self.ids()
-            index = items.index(aid)
-        except (ValueError, AttributeError):
-            return None        
+        index = self._index_maps()['col'].get(aid)
+        if index is None:
+            return None
         mg = Metagenome(aid, auth=self._auth)
         if mg.name is not None:
             return mg
@@ -461,73 +864,83 @@ class Analysis(object):
             return self.biom['columns'][index]
     
     def alpha_diversity(self):
+        """shannon diversity (as effective number, e^H) per sample of a taxonomy matrix"""
         if self.hierarchy != 'taxonomy':
             return None
-        if self.alpha_diversity is None:
-            alphaDiv = {}
-            for i, aID in enumerate(self.ids()):
-                col = slice_column(self.Dmatrix, i)
-                h1  = 0
-                s1  = sum(col)
-                if not s1:
-                    alphaDiv[aID] = 0
-                    continue
-                for n in col:
-                    p = n/s1
-                    if p > 0:
-                        h1 += (p * math.log(1/p)) / math.log(2)
-                alphaDiv[aID] = 2**h1
-            self.alpha_diversity = alphaDiv
-        return self.alpha_diversity
-
-    def rarefaction(self):
+        return self.diversity('shannon', effective=True)
+
+    def diversity(self, index=None, effective=False, rare=10):
+        """alpha diversity indices per sample from counts: richness, shannon, simpson, chao1, ace, pielou
+        index given: dict of id -> value, else dict of id -> dict of index -> value
+        effective: report shannon as e^H
+        computed for all samples at once, cached by matrix contents"""
+        if (index is not None) and (index not in INDICES):
+            sys.stderr.write("Error: invalid diversity index '%s', use one of: %s\n"%(index, ", ".join(INDICES)))
+            return None
+        if not self.biom:
+            return None
+        values = dict(alpha_indices(self._matrix(0), rare=rare))
+        if effective:
+            values['shannon'] = np.exp(values['shannon'])
+        if index is not None:
+            return dict(zip(self.ids(), values[index].tolist()))
+        return dict( (aID, dict((k, float(v[i])) for k, v in values.iteritems())) for i, aID in enumerate(self.ids()) )
+
+    def rarefaction(self, points=1000, depths=None, workers=1):
+        """expected richness curve per sample: dict of id -> list of [depth, richness]
+        uses metagenome computed curve if available, else computes over the depth grid
+        (points steps up to sequence count, or explicit depths)"""
         if self.hierarchy != 'taxonomy':
             return None
-        if self.rarefaction is None:
-            rareFact = defaultdict(list)
-            for i, aID in enumerate(self.ids()):
-                mg = self.get_id_object(aID)
-                if ('rarefaction' in mg.stats) and (len(mg.stats['rarefaction']) > 0):
-                    rareFact[aID] = mg.stats['rarefaction']
-                    continue
-                try:
-                    nseq = int(mg.stats['sequence_count_raw'])
-                    size = int(nseq/1000) if nseq > 1000 else 1
-                except (ValueError, KeyError, TypeError, AttributeError):
-                    rareFact[aID] = []
-                    continue
-                nums = slice_column(self.Dmatrix, i)
-                lnum = len(nums)
-                nums.sort()
-                for i in xrange(0, nseq, size):
-                    coeff = self._nCr2ln(nseq, i)
-                    curr  = 0
-                    for n in nums:
-                        curr += math.exp(self._nCr2ln(nseq-n, i) - coeff)
-                    rareFact[aID].append([i, lnum-curr])
-            self.rarefaction = rareFact
-        return self.rarefaction
-
-    def _nCr2ln(self, n, r):
-        c = 1
-        if r > n:
-            return c
-        if (r < 50) and (n < 50):
-            for x in xrange(0, r-1):
-                c += (c * (n-x)) / (x+1)
-            return math.log(c)
-        if r <= n:
-            c = self._gammaln(n+1) - self._gammaln(r+1) - self._gammaln(n-r)
-        else:
-            c = -1000
-        return c
+        key = (points, tuple(depths) if depths is not None else None)
+        if (self._rarefaction is None) or (self._rarefaction[0] != key):
+            self._rarefaction = (key, {})
+        rareFact = self._rarefaction[1]
+        # curves are per sample, only compute added samples
+        missing = [ x for x in self.ids() if x not in rareFact ]
+        results = pool_map(lambda x: self._rarefaction_curve(x, points, depths), missing, workers=workers)
+        for aID, res in zip(missing, results):
+            if res[1] is not None:
+                sys.stderr.write("Error computing rarefaction for %s: %s\n"%(aID, res[1]))
+            rareFact[aID] = res[0] if res[1] is None else []
+        return rareFact
 
-    def _gammaln(self, x):
-        if x > 0:
-            s = math.log(x)
-            return math.log(2 * math.pi) / 2 + x * s + s / 2 - x
+    def _rarefaction_curve(self, aID, points, depths):
+        mg = self.get_id_object(aID)
+        stats = getattr(mg, 'stats', None) or {}
+        if (depths is None) and ('rarefaction' in stats) and (len(stats['rarefaction']) > 0):
+            return stats['rarefaction']
+        try:
+            nseq = int(stats['sequence_count_raw'] if 'sequence_count_raw' in stats else stats['sequence_stats']['sequence_count_raw'])
+        except (ValueError, KeyError, TypeError):
+            # no sequence count, sample from annotated counts
+            nseq = None
+        return rarefaction_curve(self.column(aID), nseq=nseq, points=points, depths=depths)
+
+    def significance(self, groups, test='Kruskal-Wallis', normalize=0, rows=None):
+        """significance test of each row between groups of samples, see significance.TESTS
+        groups: dict of column id -> group label (e.g. Collection.metadata_groups), unlisted columns are left out,
+                or list of labels in column order
+        returns dict of rows, groups, stddev (per row and group), statistic, p_value, fdr (Benjamini-Hochberg)"""
+        if not self.biom:
+            return None
+        if (not rows) or (len(rows) == 0):
+            rows = self.annotations()
         else:
-            return 0
+            rows = self.force_row_ids(rows)
+        rIndex = self._row_indexes(rows)
+        labels = map(lambda x: groups.get(x), self.ids()) if isinstance(groups, dict) else list(groups)
+        try:
+            res = group_test(sub_block(self._matrix(normalize), rIndex, range(self.numIDs)), labels, test)
+        except ValueError, e:
+            sys.stderr.write("Error running %s: %s\n"%(test, e))
+            return None
+        return { 'rows': map(lambda i: self.biom['rows'][i]['id'], rIndex),
+                 'groups': res['groups'],
+                 'stddev': res['stddev'].tolist(),
+                 'statistic': res['statistic'].tolist(),
+                 'p_value': res['p_value'].tolist(),
+                 'fdr': res['fdr'].tolist() }
 
     def boxplot(self, normalize=1, title='', width=300, height=300, cols=None, rows=None, col_name=True, show_data=False, arg_list=False, source='retina'):
         # default is all
@@ -540,7 +953,7 @@ class Analysis(object):
             rows = self.force_row_ids(rows)
         data = self.sub_matrix(normalize=normalize, cols=cols, rows=rows)
         if show_data:
-            print self.dump(fformat='tab', normalize=normalize, rows=rows, cols=cols, col_name=col_name)
+            self.dump(fformat='tab', normalize=normalize, rows=rows, cols=cols, col_name=col_name, fhdl=sys.stdout)
         if source == 'retina':
             keyArgs = { 'data': data,
                         'width': width,
@@ -557,9 +970,12 @@ class Analysis(object):
                     sys.stderr.write("Error producing chart\n")
                 return None
         else:
+            if ro is None:
+                sys.stderr.write("Error producing boxplot: rpy2 is not available\n")
+                return None
             fname = Ipy.IMG_DIR+'/boxplot_'+random_str()+'.svg'
             if col_name:
-                labels = map(lambda y: y['name'], filter(lambda x: x['id'] in cols, self.biom['columns']))
+                labels = map(lambda j: self.biom['columns'][j]['name'], sorted(self._col_indexes(cols)))
             else:
                 labels = cols
             keyArgs = { 'names': ro.StrVector(labels),
@@ -578,11 +994,72 @@ class Analysis(object):
             ro.r("dev.off()")
             return fname
 
-    def pco(self, normalize=1, dist='bray-curtis', title='', col_name=True):
+    def pcoa(self, normalize=1, dist='bray-curtis', components=None, solver='auto', cols=None):
+        """principal coordinates of samples (columns), distances are cached per matrix
+        returns dict of ids, values (eigenvalues), explained (fraction of variance),
+        and coordinates (dict of id -> list of axis values)"""
+        if (not cols) or (len(cols) == 0):
+            cols = self.ids()
+        cIndex = self._col_indexes(cols)
+        matrix = self._matrix(normalize)
+        if len(cIndex) < self.numIDs:
+            matrix = sub_block(matrix, range(self.numAnnot), cIndex)
+        dvec = cached_distance(matrix.T, dist)
+        res  = pcoa(dvec, k=components, solver=solver)
+        ids  = map(lambda j: self.biom['columns'][j]['id'], cIndex)
+        return { 'ids': ids,
+                 'values': res['values'].tolist(),
+                 'explained': res['explained'].tolist(),
+                 'coordinates': dict(zip(ids, res['vectors'].tolist())) }
+
+    def pco(self, normalize=1, dist='bray-curtis', title='', col_name=True, comp=[1,2], width=700, height=500, cols=None, legend=True, arg_list=False, source='retina'):
+        """plot of samples on two principal coordinates, returns pcoa() results
+        source='R' plots all three first coordinates with R/plot_pco.r to an svg file"""
+        if source != 'retina':
+            return self._matr_pco(normalize=normalize, dist=dist, title=title, col_name=col_name)
+        result = self.pcoa(normalize=normalize, dist=dist, components=max(comp), cols=cols)
+        if len(result['values']) < max(comp):
+            sys.stderr.write("Error: not enough samples for %d coordinates\n"%max(comp))
+            return None
+        x, y   = comp[0]-1, comp[1]-1
+        colors = google_palette(len(result['ids']))
+        series = []
+        points = []
+        for i, aID in enumerate(result['ids']):
+            coord = result['coordinates'][aID]
+            label = self.biom['columns'][self._index_maps()['col'][aID]]['name'] if col_name else aID
+            series.append({'name': label, 'color': colors[i], 'shape': 'circle'})
+            points.append([{'x': coord[x], 'y': coord[y]}])
+        xs = map(lambda p: p[0]['x'], points)
+        ys = map(lambda p: p[0]['y'], points)
+        keyArgs = { 'width': width,
+                    'height': height,
+                    'title': title,
+                    'x_title': "PCO%d (%.2f%%)"%(comp[0], result['explained'][x]*100),
+                    'y_title': "PCO%d (%.2f%%)"%(comp[1], result['explained'][y]*100),
+                    'x_min': min(xs),
+                    'x_max': max(xs),
+                    'y_min': min(ys),
+                    'y_max': max(ys),
+                    'target': 'div_plot_'+random_str(),
+                    'show_legend': legend,
+                    'connected': False,
+                    'data': {'series': series, 'points': points} }
+        if Ipy.DEBUG:
+            print keyArgs
+        if arg_list:
+            return keyArgs
+        try:
+            Ipy.RETINA.plot(**keyArgs)
+        except:
+            sys.stderr.write("Error producing pco plot\n")
+        return result
+
+    def _matr_pco(self, normalize=1, dist='bray-curtis', title='', col_name=True):
         matrix = self.NRmatrix if normalize and self.NRmatrix else self.Rmatrix
         fname  = Ipy.IMG_DIR+'/pco_'+random_str()+'.svg'
         labels = self.names() if col_name else self.ids()
-        if not matrix:
+        if (ro is None) or (not matrix):
             return None
         keyArgs = { 'labels': ro.StrVector(labels),
                     'main': title,
@@ -595,13 +1072,15 @@ class Analysis(object):
         ro.r("dev.off()")
         return fname
 
-    def heatmap(self, source='retina', normalize=1, title='', dist='bray-curtis', clust='ward', width=700, height=600, cols=None, rows=None, col_name=True, row_full=False, show_data=False, arg_list=False, onclick=None):
+    def heatmap(self, source='retina', normalize=1, title='', dist='bray-curtis', clust='ward', width=700, height=600, cols=None, rows=None, col_name=True, row_full=False, show_data=False, arg_list=False, onclick=None, top=None, top_by='abundance'):
+        """retina heatmap of rows (annotations) x cols (samples), both clustered,
+        top: only the top rows of rows ranked by top_by (see top_rows), bounds clustering cost"""
         if source == 'retina':
-            return self._retina_heatmap(normalize=normalize, dist=dist, clust=clust, width=width, height=height, cols=cols, rows=rows, col_name=col_name, row_full=row_full, show_data=show_data, arg_list=arg_list, onclick=onclick)
+            return self._retina_heatmap(normalize=normalize, dist=dist, clust=clust, width=width, height=height, cols=cols, rows=rows, col_name=col_name, row_full=row_full, show_data=show_data, arg_list=arg_list, onclick=onclick, top=top, top_by=top_by)
         else:
             return self._matr_heatmap(normalize=normalize, title=title, col_name=col_name)
 
-    def _retina_heatmap(self, normalize=1, dist='bray-curtis', clust='ward', width=700, height=600, cols=None, rows=None, col_name=True, row_full=False, show_data=False, arg_list=False, onclick=None):
+    def _retina_heatmap(self, normalize=1, dist='bray-curtis', clust='ward', width=700, height=600, cols=None, rows=None, col_name=True, row_full=False, show_data=False, arg_list=False, onclick=None, top=None, top_by='abundance'):
         # default is all
         if (not cols) or (len(cols) == 0):
             cols = self.ids()
@@ -610,29 +1089,22 @@ class Analysis(object):
         # force rows to be row ids
         else:
             rows = self.force_row_ids(rows)
-        # run our own R code
-        matrix_file = Ipy.TMP_DIR+'/matrix.'+random_str()+'.tab'
-        col_file = Ipy.TMP_DIR+'/col_clust.'+random_str()+'.txt'
-        row_file = Ipy.TMP_DIR+'/row_clust.'+random_str()+'.txt'
-        dump_str = self.dump(fformat='tab', normalize=normalize, rows=rows, cols=cols, col_name=col_name, row_full=row_full)
-        dump_set = dump_str.strip().split("\n")
-        cols = dump_set[0].strip().split("\t")
-        rows = map(lambda x: x.split("\t")[0], dump_set[1:])
+        if top:
+            rows = self.top_rows(top, by=top_by, normalize=normalize, rows=rows, cols=cols)
+            if rows is None:
+                return None
         if show_data:
-            print dump_str
-        open(matrix_file, 'w').write(dump_str)
-        rcmd = 'source("%s")\nMGRAST_dendrograms(file_in="%s", file_out_column="%s", file_out_row="%s", dist_method="%s", clust_method="%s", produce_figures="FALSE")\n'%(Ipy.LIB_DIR+'/dendrogram.r', matrix_file, col_file, row_file, dist, clust)
-        ro.r(rcmd)
-        cord, cdist = ordered_distance_from_file(col_file)
-        rord, rdist = ordered_distance_from_file(row_file)
-        sub_matrix  = matrix_from_file(matrix_file)
-        data = { 'columns': cols,
-                 'rows': rows,
-                 'colindex': cord,
-                 'rowindex': rord,
-                 'coldend': cdist,
-                 'rowdend': rdist,
-                 'data': sub_matrix }
+            self.dump(fformat='tab', normalize=normalize, rows=rows, cols=cols, col_name=col_name, row_full=row_full, fhdl=sys.stdout)
+        # cluster sub matrix in process
+        rIndex = self._row_indexes(rows)
+        cIndex = self._col_indexes(cols)
+        sub_matrix = sub_block(self._matrix(normalize), rIndex, cIndex)
+        cols = map(lambda j: self.biom['columns'][j]['name'] if col_name else self.biom['columns'][j]['id'], cIndex)
+        rows = map(lambda i: self._row_label(i, row_full), rIndex)
+        data = dendrograms(sub_matrix, dist=dist, clust=clust)
+        data['columns'] = cols
+        data['rows'] = rows
+        data['data'] = sub_matrix.tolist()
         lwidth  = len(max(rows, key=len)) * 7.2
         keyArgs = { 'data': data,
                     'width': int(width+lwidth),
@@ -656,7 +1128,7 @@ class Analysis(object):
         matrix = self.NRmatrix if normalize and self.NRmatrix else self.Rmatrix
         fname  = Ipy.IMG_DIR+'/heatmap_'+random_str()+'.svg'
         labels = self.names() if col_name else self.ids()
-        if not matrix:
+        if (ro is None) or (not matrix):
             return None
         keyArgs = { 'labCol': ro.StrVector(labels),
                     'labRow': '',
@@ -670,9 +1142,9 @@ class Analysis(object):
         ro.r("dev.off()")
         return fname
 
-    def barchart(self, normalize=1, width=800, height=0, x_rotate='0', title="", legend=True, cols=None, rows=None, col_name=True, row_full=False, show_data=False, arg_list=False, onclick=None):
-        matrix  = self.NDmatrix if normalize and self.NDmatrix else self.Dmatrix
-        if not matrix:
+    def barchart(self, normalize=1, width=800, height=0, x_rotate='0', title="", legend=True, cols=None, rows=None, col_name=True, row_full=False, show_data=False, arg_list=False, onclick=None, top=None, top_by='abundance'):
+        matrix  = self._matrix(normalize)
+        if (self.numAnnot == 0) or (self.numIDs == 0):
             sys.stderr.write("Error producing chart: empty matrix\n")
             return None
         # default is all
@@ -684,34 +1156,27 @@ class Analysis(object):
         # force rows to be row ids
         else:
             rows = self.force_row_ids(rows)
+        if top:
+            rows = self.top_rows(top, by=top_by, normalize=normalize, rows=rows, cols=cols)
+            if rows is None:
+                return None
         colors = google_palette(len(cols))
         labels = []
         data   = []
         # show data
         if show_data:
-            print self.dump(fformat='tab', normalize=normalize, rows=rows, cols=cols, col_name=col_name, row_full=row_full)
+            self.dump(fformat='tab', normalize=normalize, rows=rows, cols=cols, col_name=col_name, row_full=row_full, fhdl=sys.stdout)
         # set retina data
-        for i, m in enumerate(cols):
-            try:
-                j = all_ids.index(m)
-                data.append({'name': m if not col_name else self.biom['columns'][j]['name'], 'data': [], 'fill': colors[i]})
-            except:
-                pass
-        # populate data from matrix
-        for r, row in enumerate(matrix):
-            # only use sub rows
-            rdata = self.biom['rows'][r]
-            if rdata['id'] in rows:
-                if row_full and self.hierarchy and rdata['metadata'] and (self.hierarchy in rdata['metadata']):
-                    labels.append(";".join( map(lambda x: 'none' if x is None else x, rdata['metadata'][self.hierarchy]) ))
-                else:
-                    labels.append(rdata['id'])
-            else:
-                continue
-            # only use sub cols
-            for i, m in enumerate(cols):
-                j = all_ids.index(m)
-                data[i]['data'].append( toNum(row[j]) )
+        cIndex = self._col_indexes(cols)
+        for i, j in enumerate(cIndex):
+            data.append({'name': all_ids[j] if not col_name else self.biom['columns'][j]['name'], 'data': [], 'fill': colors[i]})
+        # only use sub rows, in matrix order
+        rIndex = sorted(set(self._row_indexes(rows)))
+        labels = map(lambda r: self._row_label(r, row_full), rIndex)
+        # populate data from sub matrix
+        sub_matrix = sub_block(matrix, rIndex, cIndex)
+        for i in range(len(cIndex)):
+            data[i]['data'] = sub_matrix[:,i].tolist()
         height  = height if height else len(labels)*len(cols)*7.5
         lheight = min(height, len(cols)*35)
         lwidth  = len(max(labels, key=len)) * 7.2
@@ -728,7 +1193,7 @@ class Analysis(object):
                     'chartArea': [int(lwidth), 0.02, cwidth, 0.95],
                     'data': data,
                     'onclick': onclick }
-        if normalize and self.NDmatrix:
+        if normalize and (self.NDmatrix is not None):
             keyArgs['y_labeled_tick_interval'] = 0.1
         if Ipy.DEBUG:
             print cols, rows, keyArgs
@@ -745,10 +1210,14 @@ class Analysis(object):
         # skip single metagenome matrix
         if self.numIDs == 1:
             return
+        # R is only used if asked for
+        if not (Ipy.USE_R and ro):
+            self._ndmatrix, self._norm_stats = preprocess_stats(self._matrix(0))
+            return
         try:
             # can matr do it ?
-            self.NRmatrix = ro.r.normalize(self.Rmatrix)
-            self.NDmatrix = rMatrix_to_pyMatrix(self.NRmatrix, self.numAnnot, self.numIDs)
+            self._nrmatrix = ro.r.normalize(self.Rmatrix)
+            self._ndmatrix = rMatrix_to_pyMatrix(self._nrmatrix, self.numAnnot, self.numIDs)
         except:
             try:
                 # run our own R code
@@ -757,15 +1226,43 @@ class Analysis(object):
                 self.dump(fname=raw_file, fformat='tab', normalize=0)
                 rcmd = 'source("%s")\nMGRAST_preprocessing(file_in="%s", file_out="%s", produce_fig="FALSE")\n'%(Ipy.LIB_DIR+'/preprocessing.r', raw_file, norm_file)
                 ro.r(rcmd)
-                self.NDmatrix = matrix_from_file(norm_file, has_col_names=True, has_row_names=True)
-                self.NRmatrix = pyMatrix_to_rMatrix(self.NDmatrix, self.numAnnot, self.numIDs, normalize=1)
+                self._ndmatrix = np.array(matrix_from_file(norm_file, has_col_names=True, has_row_names=True), dtype=float)
+                self._nrmatrix = pyMatrix_to_rMatrix(self._ndmatrix, self.numAnnot, self.numIDs, normalize=1)
             except:
                 sys.stderr.write("Error normalizing matrix (%s)\n"%self.id)
 
-    def _dense_matrix(self):
+    def _load_matrix(self):
         if not self.biom:
-            return []
-        if self.biom['matrix_type'] == 'dense':
-            return self.biom['data']
+            self._dmatrix = np.zeros((0, 0))
+            return
+        # keep one typed copy of the data, shared with the biom
+        self.biom['data'] = biom_matrix(self.biom)
+        if self.biom['matrix_type'] == 'sparse':
+            self.Smatrix = self.biom['data']
         else:
-            return sparse_to_dense(self.biom['data'], self.numAnnot, self.numIDs)
+            self._dmatrix = self.biom['data']
+
+def get_matrix(ids, annotation=None, level=None, result_type=None, source=None, e_val=None, ident=None, alen=None, filters=[], filter_source=None, auth=None, raise_errors=False):
+    """returns BIOM object from matrix api call for list of metagenome ids, see obj_from_url for raise_errors"""
+    params = map(lambda x: ('id', x), ids)
+    if not annotation:
+        annotation = Ipy.MATRIX['annotation']
+    if level:
+        params.append(('group_level', level))
+    if result_type:
+        params.append(('result_type', result_type))
+    if source:
+        params.append(('source', source))
+    if e_val:
+        params.append(('evalue', str(e_val)))
+    if ident:
+        params.append(('identity', str(ident)))
+    if alen:
+        params.append(('length', str(alen)))
+    if len(filters) > 0:
+        params.extend( map(lambda x: ('filter', x), filters) )
+        if filter_source:
+            params.append(('filter_source', filter_source))
+    if auth:
+        params.append(('auth', auth))
+    return obj_from_url( Ipy.API_URL+'matrix/'+annotation+'?'+urllib.urlencode(params, True), raise_errors=raise_errors )
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import re, bisect
+import numpy as np
+from collections import defaultdict
+
+FIELDS = ['id', 'leaf', 'lineage']
+# pattern characters with regex meaning, literal when escaped with '\'
+REGEX_CHARS = set('.^$*+?{}[]|()\\')
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+class AnnotationIndex(object):
+    """Case-insensitive search index of biom rows, built once per set of rows:
+        id      : row id
+        leaf    : last name of the row hierarchy (taxonomy / ontology) metadata
+        lineage : all names of the row hierarchy metadata, joined by ';'
+
+    search() answers plain text (substring), '^text' (prefix), 'text$' (suffix) and
+    '^text$' (exact) patterns with string search of one text per field, other patterns
+    with a regex over each row. token() looks up whole words.
+    Results are sorted numpy arrays of row indexes.
+    """
+    def __init__(self, rows, hierarchy=None):
+        self.size = len(rows)
+        self.hierarchy = hierarchy
+        self._rows   = rows
+        self._texts  = {}  # field -> text of each row, None if missing
+        self._blobs  = {}  # field -> (text of all rows, row start offsets, row indexes)
+        self._tokens = {}  # field -> token -> row indexes
+
+    def __len__(self):
+        return self.size
+
+    def search(self, pattern, fields=['id', 'leaf']):
+        """rows where pattern matches (re.search, ignoring case) any of fields"""
+        literal = _literal(pattern)
+        found = []
+        for field in fields:
+            if literal and literal[0]:
+                found.append(self._find(field, *literal))
+            else:
+                found.append(self._regex(field, pattern))
+        return _union(found)
+
+    def token(self, words, fields=FIELDS):
+        """rows that have every word of words as a whole word (ignoring case) in any of fields"""
+        found = None
+        for word in TOKEN_RE.findall(_text(words).lower()):
+            rows = _union([ self._token_index(f).get(word, []) for f in fields ])
+            found = rows if found is None else np.intersect1d(found, rows)
+        return found if found is not None else np.zeros(0, dtype=int)
+
+    def texts(self, field):
+        """text of field for each row, None if the row has no hierarchy, built on first use"""
+        if field not in self._texts:
+            if field == 'id':
+                texts = map(lambda r: r['id'], self._rows)
+            elif field == 'leaf':
+                texts = map(lambda x: x[-1] if x and x[-1] else None, map(self._lineage, self._rows))
+            elif field == 'lineage':
+                texts = map(lambda x: ";".join(map(lambda y: y if y else 'none', x)) if x else None, map(self._lineage, self._rows))
+            else:
+                raise ValueError("invalid field '%s', use one of: %s"%(field, ", ".join(FIELDS)))
+            self._texts[field] = texts
+        return self._texts[field]
+
+    def _lineage(self, row):
+        if self.hierarchy and row['metadata'] and (self.hierarchy in row['metadata']):
+            return row['metadata'][self.hierarchy]
+        return None
+
+    def _find(self, field, literal, prefix, suffix):
+        blob, starts, rows = self._blob(field)
+        needle = (u'\n' if prefix else u'') + literal.lower() + (u'\n' if suffix else u'')
+        shift  = 1 if prefix else 0
+        hits = []
+        pos  = blob.find(needle)
+        while pos >= 0:
+            # row of the hit, then continue at the next row
+            k = bisect.bisect_right(starts, pos + shift) - 1
+            hits.append(rows[k])
+            if k + 1 >= len(starts):
+                break
+            pos = blob.find(needle, starts[k+1] - shift)
+        return np.array(hits, dtype=int)
+
+    def _regex(self, field, pattern):
+        str_re = re.compile(pattern, re.IGNORECASE | re.UNICODE)
+        return np.array([ i for i, t in enumerate(self.texts(field)) if (t is not None) and str_re.search(t) ], dtype=int)
+
+    def _blob(self, field):
+        # one newline separated text per field, rows start after a newline
+        if field not in self._blobs:
+            texts = self.texts(field)
+            rows  = [ i for i, t in enumerate(texts) if t is not None ]
+            parts = [ texts[i].lower() for i in rows ]
+            try:
+                blob = u'\n'+u'\n'.join(parts)+u'\n'
+            except UnicodeDecodeError:
+                # non-ascii byte strings
+                parts = map(_text, parts)
+                blob  = u'\n'+u'\n'.join(parts)+u'\n'
+            starts, pos = [], 1
+            for p in parts:
+                starts.append(pos)
+                pos += len(p) + 1
+            self._blobs[field] = (blob, starts, rows)
+        return self._blobs[field]
+
+    def _token_index(self, field):
+        if field not in self._tokens:
+            index = defaultdict(list)
+            for i, t in enumerate(self.texts(field)):
+                if t is None:
+                    continue
+                for word in set(TOKEN_RE.findall(_text(t).lower())):
+                    index[word].append(i)
+            self._tokens[field] = index
+        return self._tokens[field]
+
+def _literal(pattern):
+    """(text, prefix, suffix) of a pattern that is plain text with optional ^ and $ anchors, else None"""
+    prefix = pattern.startswith('^')
+    core = pattern[1:] if prefix else pattern
+    suffix = False
+    text, i = [], 0
+    while i < len(core):
+        c = core[i]
+        if c == '\\':
+            # escaped punctuation is literal, escapes like \d \w are not
+            if (i + 1 < len(core)) and (not core[i+1].isalnum()) and (core[i+1] != '_'):
+                text.append(core[i+1])
+                i += 2
+                continue
+            return None
+        if (c == '$') and (i == len(core) - 1):
+            suffix = True
+        elif c in REGEX_CHARS:
+            return None
+        else:
+            text.append(c)
+        i += 1
+    return _text("".join(text)), prefix, suffix
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+def _union(arrays):
+    arrays = [ np.asarray(a, dtype=int) for a in arrays if len(a) > 0 ]
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=int)
+    return np.unique(np.concatenate(arrays))
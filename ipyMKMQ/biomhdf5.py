@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import json
+from datetime import datetime
+import numpy as np
+import scipy.sparse as sp
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+FORMAT_URL = "http://biom-format.org"
+FORMAT_VERSION = [2, 1]
+
+def is_hdf5(fname):
+    return (h5py is not None) and h5py.is_hdf5(fname)
+
+def write(fname, biom, matrix, compression='gzip', chunk=65536):
+    """write biom (1.0 dict) and its typed matrix (numpy array or csr) as BIOM 2.1 HDF5:
+        observation/matrix : csr of rows, for row subset reads
+        sample/matrix      : csr of columns, for column subset reads
+        */ids, */metadata  : row / column ids and metadata (utf-8 strings), equal length string lists
+                             as 2-D string datasets (e.g. taxonomy, None as ''), other values json encoded
+    datasets are chunked (chunk values) and compressed"""
+    if h5py is None:
+        raise ImportError("h5py is required for BIOM 2.x HDF5 files")
+    csr = sp.csr_matrix(matrix)
+    csr.sum_duplicates()
+    hdl = h5py.File(fname, 'w')
+    try:
+        hdl.attrs['id'] = biom.get('id') or ''
+        hdl.attrs['type'] = biom.get('type') or ''
+        hdl.attrs['format-url'] = FORMAT_URL
+        hdl.attrs['format-version'] = FORMAT_VERSION
+        hdl.attrs['generated-by'] = biom.get('generated_by') or ''
+        hdl.attrs['creation-date'] = datetime.now().isoformat()
+        hdl.attrs['shape'] = list(csr.shape)
+        hdl.attrs['nnz'] = csr.nnz
+        hdl.attrs['matrix-element-type'] = biom.get('matrix_element_type') or ''
+        hdl.attrs['matrix-element-value'] = biom.get('matrix_element_value') or ''
+        for name, entries, part in (('observation', biom['rows'], csr), ('sample', biom['columns'], csr.T.tocsr())):
+            grp = hdl.create_group(name)
+            _write_strings(grp, 'ids', [ e['id'] for e in entries ], compression, chunk)
+            for key, array in (('data', part.data), ('indices', part.indices), ('indptr', part.indptr)):
+                _write_array(grp, 'matrix/'+key, array, compression, chunk)
+            _write_fields(grp.create_group('metadata'), [ e.get('metadata') or {} for e in entries ], compression, chunk)
+            # biom 1.0 entry keys outside metadata, e.g. column name
+            extra = [ dict((k, v) for k, v in e.iteritems() if k not in ('id', 'metadata')) for e in entries ]
+            _write_fields(grp.create_group('fields'), extra, compression, chunk)
+            grp.create_group('group-metadata')
+    finally:
+        hdl.close()
+
+def read(fname, rows=None, cols=None):
+    """read BIOM 2.x HDF5 file as a biom 1.0 dict with csr data (matrix_type 'sparse')
+    rows / cols: lists of row / column ids to read, only their parts of the matrix are read"""
+    if h5py is None:
+        raise ImportError("h5py is required for BIOM 2.x HDF5 files")
+    hdl = h5py.File(fname, 'r')
+    try:
+        attrs  = hdl.attrs
+        rids   = _read_strings(hdl['observation/ids'])
+        cids   = _read_strings(hdl['sample/ids'])
+        rIndex = _index(rids, rows)
+        cIndex = _index(cids, cols)
+        etype  = _attr(attrs, 'matrix-element-type') or ('int' if hdl['observation/matrix/data'].dtype.kind in 'iu' else 'float')
+        dtype  = np.int64 if etype == 'int' else np.float64
+        if (rows is not None) or (cols is None):
+            matrix = _read_csr(hdl['observation/matrix'], rIndex, len(cids), dtype)
+            if cols is not None:
+                matrix = matrix[:,cIndex]
+        else:
+            matrix = _read_csr(hdl['sample/matrix'], cIndex, len(rids), dtype).T.tocsr()
+        biom = { 'id': _attr(attrs, 'id'),
+                 'format': "Biological Observation Matrix 1.0",
+                 'format_url': "http://biom-format.org/documentation/format_versions/biom-1.0.html",
+                 'type': _attr(attrs, 'type'),
+                 'generated_by': _attr(attrs, 'generated-by'),
+                 'date': _attr(attrs, 'creation-date'),
+                 'matrix_type': 'sparse',
+                 'matrix_element_type': etype,
+                 'matrix_element_value': _attr(attrs, 'matrix-element-value') or 'abundance',
+                 'shape': [len(rIndex), len(cIndex)],
+                 'rows': _read_entries(hdl['observation'], rids, rIndex),
+                 'columns': _read_entries(hdl['sample'], cids, cIndex),
+                 'data': matrix }
+    finally:
+        hdl.close()
+    return biom
+
+def _attr(attrs, key):
+    value = attrs.get(key)
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def _index(ids, subset):
+    if subset is None:
+        return range(len(ids))
+    pos = dict( (x, i) for i, x in enumerate(ids) )
+    missing = [ x for x in subset if x not in pos ]
+    if missing:
+        raise KeyError("ids not in file: %s"%", ".join(map(str, missing[:10])))
+    return [ pos[x] for x in subset ]
+
+def _read_csr(grp, index, width, dtype):
+    # read data / indices of the requested rows as contiguous runs of sorted rows
+    indptr = grp['indptr'][...]
+    if len(index) == len(indptr) - 1 and list(index) == range(len(index)):
+        return sp.csr_matrix((grp['data'][...].astype(dtype), grp['indices'][...], indptr), shape=(len(index), width))
+    order, sindex, inverse = _sorted_index(index)
+    data, indices, counts = [], [], np.zeros(len(index), dtype=np.int64)
+    for start, end in _runs(sindex):
+        lo, hi = indptr[sindex[start]], indptr[sindex[end-1] + 1]
+        block_data, block_indices = grp['data'][lo:hi], grp['indices'][lo:hi]
+        for k in range(start, end):
+            a, b = indptr[sindex[k]] - lo, indptr[sindex[k] + 1] - lo
+            data.append(block_data[a:b])
+            indices.append(block_indices[a:b])
+            counts[k] = b - a
+    # back to requested order
+    sub = sp.csr_matrix((np.concatenate(data).astype(dtype) if data else np.zeros(0, dtype=dtype),
+                         np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+                         np.concatenate([[0], np.cumsum(counts)])), shape=(len(index), width))
+    return sub[inverse]
+
+def _sorted_index(index):
+    # sort order of index, sorted index, and positions of index items in the sorted one
+    order   = np.argsort(np.asarray(index, dtype=np.int64), kind='mergesort')
+    sindex  = np.asarray(index, dtype=np.int64)[order]
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.arange(len(order))
+    return order, sindex, inverse
+
+def _runs(sindex):
+    # (start, end) positions of runs of contiguous (or repeated) values of sorted index
+    start = 0
+    while start < len(sindex):
+        end = start + 1
+        while (end < len(sindex)) and (sindex[end] <= sindex[end-1] + 1):
+            end += 1
+        yield start, end
+        start = end
+
+def _read_entries(grp, ids, index):
+    meta   = _read_fields(grp['metadata'], index) if 'metadata' in grp else {}
+    fields = _read_fields(grp['fields'], index) if 'fields' in grp else {}
+    entries = []
+    for n, i in enumerate(index):
+        entry = { 'id': ids[i], 'metadata': dict( (k, v[n]) for k, v in meta.iteritems() if v[n] is not None ) }
+        for k, v in fields.iteritems():
+            if v[n] is not None:
+                entry[k] = v[n]
+        entries.append(entry)
+    return entries
+
+def _write_fields(grp, values, compression, chunk):
+    keys = sorted(set( k for v in values for k in v.iterkeys() ))
+    for key in keys:
+        items = [ v.get(key) for v in values ]
+        if _is_string_table(items):
+            # missing names (e.g. unclassified levels) are stored as empty strings
+            table = np.empty((len(items), len(items[0])), dtype=object)
+            for i, x in enumerate(items):
+                table[i] = [ '' if y is None else y for y in x ]
+            _write_strings(grp, key, table, compression, chunk, attrs={'empty': 'null'})
+        else:
+            _write_strings(grp, key, [ json.dumps(x) for x in items ], compression, chunk, attrs={'encoding': 'json'})
+
+def _read_fields(grp, index):
+    fields = {}
+    for key, dset in grp.iteritems():
+        values = _read_strings(dset, index)
+        if dset.attrs.get('encoding') == 'json':
+            fields[key] = [ json.loads(x) for x in values ]
+        elif dset.ndim == 2:
+            empty = None if dset.attrs.get('empty') == 'null' else ''
+            fields[key] = [ [ y or empty for y in x ] for x in values ]
+        else:
+            fields[key] = list(values)
+    return fields
+
+def _is_string_table(items):
+    if (len(items) == 0) or (not all(isinstance(x, list) for x in items)):
+        return False
+    width = len(items[0])
+    return (width > 0) and all( (len(x) == width) and all((y is None) or isinstance(y, basestring) for y in x) for x in items )
+
+def _write_strings(grp, name, values, compression, chunk, attrs={}):
+    # fixed width utf-8, variable length string heaps are not compressed by hdf5
+    values = np.asarray(values, dtype=object) if not isinstance(values, np.ndarray) else values
+    encoded = np.array([ x.encode('utf-8') if isinstance(x, unicode) else str(x) for x in values.ravel() ], dtype=object)
+    width = max([1] + map(len, encoded))
+    array = encoded.astype('S%d'%width).reshape(values.shape)
+    dset = grp.create_dataset(name, data=array, **_chunk_opts(array.shape, compression, chunk))
+    for k, v in attrs.iteritems():
+        dset.attrs[k] = v
+
+def _read_strings(dset, index=None):
+    # only the runs of rows in index are read
+    if (index is None) or (list(index) == range(dset.shape[0])):
+        values = dset[...]
+    else:
+        order, sindex, inverse = _sorted_index(index)
+        parts = [ dset[sindex[start]:sindex[end-1]+1][sindex[start:end] - sindex[start]] for start, end in _runs(sindex) ]
+        values = np.concatenate(parts)[inverse] if parts else dset[0:0]
+    if values.ndim == 2:
+        return [ [ _text(y) for y in x ] for x in values ]
+    return [ _text(x) for x in values ]
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def _write_array(grp, name, array, compression, chunk):
+    grp.create_dataset(name, data=array, **_chunk_opts(array.shape, compression, chunk))
+
+def _chunk_opts(shape, compression, chunk):
+    # hdf5 can not chunk empty datasets
+    if (not compression) or (len(shape) == 0) or (shape[0] == 0):
+        return {}
+    return { 'chunks': (min(shape[0], chunk),) + tuple(shape[1:]),
+             'compression': compression,
+             'shuffle': True }
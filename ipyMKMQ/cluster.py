@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial.distance import pdist, cdist, squareform
+from scipy.cluster.hierarchy import linkage
+from fpcache import FingerprintCache
+
+# dist_method and clust_method options of R/dendrogram.r and R/plot_pco.r
+DIST_METHODS  = ['euclidean', 'maximum', 'manhattan', 'canberra', 'binary', 'minkowski', 'bray-curtis', 'jaccard', 'mahalanobis', 'sorensen', 'difference']
+CLUST_METHODS = ['ward', 'single', 'complete', 'average', 'mcquitty', 'median', 'centroid']
+# distances that zero valued columns do not change
+PAD_METHODS   = ['euclidean', 'maximum', 'manhattan', 'minkowski', 'binary', 'bray-curtis', 'jaccard', 'sorensen']
+CACHE_SIZE = 16
+
+_cache = FingerprintCache(CACHE_SIZE)  # (fingerprint, method) -> distance vector
+
+def distance(matrix, method='bray-curtis'):
+    """condensed distance vector between rows of matrix, as R dist() / ecodist distance() compute them"""
+    data = matrix.toarray() if sp.issparse(matrix) else np.asarray(matrix)
+    data = data.astype(float)
+    if data.shape[0] < 2:
+        return np.zeros(0)
+    if method == 'euclidean':
+        return pdist(data, 'euclidean')
+    elif method == 'maximum':
+        return pdist(data, 'chebyshev')
+    elif method == 'manhattan':
+        return pdist(data, 'cityblock')
+    elif method == 'minkowski':
+        # R default p = 2
+        return pdist(data, 'minkowski', p=2)
+    elif method == 'canberra':
+        return _canberra(data)
+    elif method == 'binary':
+        return _nan_to_zero(pdist(data > 0, 'jaccard'))
+    elif method == 'bray-curtis':
+        return _nan_to_zero(pdist(data, 'braycurtis'))
+    elif method == 'jaccard':
+        # ecodist: 2B / (1 + B), B is bray-curtis
+        bc = _nan_to_zero(pdist(data, 'braycurtis'))
+        return (2 * bc) / (1 + bc)
+    elif method == 'mahalanobis':
+        # ecodist: squared mahalanobis distance
+        vinv = np.linalg.pinv(np.atleast_2d(np.cov(data, rowvar=False)))
+        return pdist(data, 'mahalanobis', VI=vinv) ** 2
+    elif method == 'sorensen':
+        return _nan_to_zero(pdist(data > 0, 'dice'))
+    elif method == 'difference':
+        # mean absolute difference, simple difference for a single variable
+        return pdist(data, 'cityblock') / data.shape[1]
+    else:
+        raise ValueError("invalid distance method '%s', use one of: %s"%(method, ", ".join(DIST_METHODS)))
+
+def cached_distance(matrix, method='bray-curtis'):
+    """distance() result, reused while matrix contents are unchanged
+    returned vector is read-only"""
+    return _cache.get(matrix, method, lambda: distance(matrix, method))
+
+def extend_cache(old, new):
+    """seed the distance cache of matrix new from cached distances of matrix old,
+    where new is old padded with zero columns plus appended rows: for PAD_METHODS
+    only the distances to the appended rows are computed"""
+    dense = []
+    def merge(method, dvec):
+        if method not in PAD_METHODS:
+            return None
+        if not dense:
+            dense.append( (new.toarray() if sp.issparse(new) else np.asarray(new)).astype(float) )
+        data  = dense[0]
+        size  = old.shape[0]
+        cross = _cross_distance(data[size:], data, method)
+        square = np.zeros((data.shape[0], data.shape[0]))
+        square[:size,:size] = squareform(dvec, checks=False)
+        square[size:,:] = cross
+        square[:,size:] = cross.T
+        np.fill_diagonal(square, 0)
+        return squareform(square, checks=False)
+    _cache.extend(old, new, merge)
+
+def hclust(matrix, dist='bray-curtis', clust='ward'):
+    """hierarchical clustering of rows of matrix, returns R hclust style results:
+        order : list of 1-based row indexes in dendrogram order
+        merge : list of [a, b, height] for each merge step, negative a / b are
+                1-based singletons, positive are the cluster formed at that step
+    """
+    n = matrix.shape[0]
+    if n < 2:
+        return range(1, n+1), []
+    if clust not in CLUST_METHODS:
+        raise ValueError("invalid cluster method '%s', use one of: %s"%(clust, ", ".join(CLUST_METHODS)))
+    dvec = cached_distance(matrix, dist)
+    if clust in ('ward', 'median', 'centroid'):
+        # R applies the Lance-Williams update to the distances as given,
+        # scipy applies it to squared distances: cluster sqrt(d) then square heights
+        link = linkage(np.sqrt(np.maximum(dvec, 0)), method=clust)
+        link[:,2] = link[:,2] ** 2
+    else:
+        # cached distances are read-only, scipy linkage needs a writable array
+        link = linkage(np.array(dvec), method='weighted' if clust == 'mcquitty' else clust)
+    return _hclust_from_linkage(link, n)
+
+def dendrograms(matrix, dist='bray-curtis', clust='ward'):
+    """row and column clustering of matrix as R/dendrogram.r MGRAST_dendrograms outputs it
+    returns dict of retina heatmap keys: colindex, rowindex, coldend, rowdend"""
+    data = matrix.toarray() if sp.issparse(matrix) else np.asarray(matrix)
+    rord, rdend = hclust(data, dist, clust)
+    cord, cdend = hclust(data.T, dist, clust)
+    return { 'colindex': cord[::-1],
+             'rowindex': rord,
+             'coldend': cdend,
+             'rowdend': rdend }
+
+def _cross_distance(a, b, method):
+    # distance() between rows of a and rows of b, for PAD_METHODS
+    if method == 'euclidean':
+        return cdist(a, b, 'euclidean')
+    elif method == 'maximum':
+        return cdist(a, b, 'chebyshev')
+    elif method == 'manhattan':
+        return cdist(a, b, 'cityblock')
+    elif method == 'minkowski':
+        return cdist(a, b, 'minkowski', p=2)
+    elif method == 'binary':
+        return _nan_to_zero(cdist(a > 0, b > 0, 'jaccard'))
+    elif method == 'bray-curtis':
+        return _nan_to_zero(cdist(a, b, 'braycurtis'))
+    elif method == 'jaccard':
+        bc = _nan_to_zero(cdist(a, b, 'braycurtis'))
+        return (2 * bc) / (1 + bc)
+    elif method == 'sorensen':
+        return _nan_to_zero(cdist(a > 0, b > 0, 'dice'))
+    raise ValueError("distance '%s' can not be extended"%method)
+
+def _nan_to_zero(dvec):
+    # all zero rows give 0 / 0
+    dvec[np.isnan(dvec)] = 0
+    return dvec
+
+def _canberra(data):
+    # terms with zero numerator and denominator are dropped and the sum is scaled up, as R does
+    n, p = data.shape
+    dvec = []
+    for i in range(n-1):
+        num = np.abs(data[i] - data[i+1:])
+        den = np.abs(data[i] + data[i+1:])
+        valid = (num > 0) | (den > 0)
+        terms = np.where(valid, num / np.where(den > 0, den, 1), 0).sum(axis=1)
+        count = valid.sum(axis=1)
+        dvec.append(np.where(count > 0, terms * p / np.maximum(count, 1), 0))
+    return np.concatenate(dvec)
+
+def _hclust_from_linkage(link, n):
+    # scipy labels: 0..n-1 singletons, n+i cluster of step i
+    # R labels: -1..-n singletons, i+1 cluster of step i
+    merge = []
+    for a, b, height, size in link:
+        pair = [ -(int(x)+1) if x < n else int(x)-n+1 for x in (a, b) ]
+        if (pair[0] < 0) and (pair[1] < 0):
+            pair.sort(reverse=True)
+        elif (pair[0] > 0) and (pair[1] > 0):
+            pair.sort()
+        elif pair[0] > 0:
+            pair.reverse()
+        merge.append([pair[0], pair[1], float(height)])
+    # order is left to right traversal from the last merge
+    order = []
+    stack = [len(merge)]
+    while stack:
+        node = stack.pop()
+        if node < 0:
+            order.append(-node)
+        else:
+            stack.append(merge[node-1][1])
+            stack.append(merge[node-1][0])
+    return order, merge
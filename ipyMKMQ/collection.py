@@ -10,9 +10,11 @@ class Collection(object):
         metagenomes : [ 'hash', 'key = metagenome_id, value = metagenome.Metagenome() object']
         _mgids : [ 'list', 'inputted metagenome ids' ]
         
+        metagenomes are loaded in parallel when workers > 1, progress(done, total, mgid) is called as each one arrives
+        
         Metagenome object:
         """+Metagenome.__doc__
-    def __init__(self, mgids, metadata=True, stats=True, auth=None, def_name=None, cache=None):
+    def __init__(self, mgids, metadata=True, stats=True, auth=None, def_name=None, cache=None, workers=1, progress=None):
         self._auth  = auth
         self._stats = stats
         # hack to get variable name
@@ -25,11 +27,10 @@ class Collection(object):
         self.defined_name = def_name
         # get metagenomes
         self._mgids = mgids
-        self.metagenomes = self._get_metagenomes(mgids, metadata, stats, cdir=cache)
+        self.metagenomes = self._get_metagenomes(mgids, metadata, stats, cdir=cache, workers=workers, progress=progress)
     
-    def _get_metagenomes(self, mgids, metadata, stats, cdir=None):
-        mgs = {}
-        for mg in mgids:
+    def _get_metagenomes(self, mgids, metadata, stats, cdir=None, workers=1, progress=None):
+        def load(mg):
             keyArgs = { 'metadata': metadata,
                         'stats': stats,
                         'auth': self._auth,
@@ -38,7 +39,14 @@ class Collection(object):
                        }
             if cdir and os.path.isfile(cdir+'/'+mg+'.json'):
                 keyArgs['mfile'] = cdir+'/'+mg+'.json'
-            mgs[mg] = Metagenome(mg, **keyArgs)
+            return Metagenome(mg, **keyArgs)
+        mgs = {}
+        # each metagenome writes its own cache file as it is loaded
+        for mg, res in zip(mgids, pool_map(load, mgids, workers=workers, progress=progress)):
+            if res[1] is not None:
+                sys.stderr.write("Error loading metagenome %s: %s\n"%(mg, res[1]))
+                continue
+            mgs[mg] = res[0]
         return mgs
     
     def _set_statistics(self):
@@ -85,6 +93,22 @@ class Collection(object):
                         sub_mgs.add(mid)
         return list(sub_mgs)
 
+    def metadata_groups(self, field=None, category=None):
+        """dict of metagenome id -> value of metadata field, for grouping samples
+        metagenomes without the field are left out, category limits the search to one of Ipy.MD_CATS"""
+        groups = {}
+        cats = [category] if category else Ipy.MD_CATS
+        for mid, mg in self.metagenomes.iteritems():
+            if not hasattr(mg, 'metadata'):
+                continue
+            for cat in cats:
+                if (cat in mg.metadata) and (field in mg.metadata[cat]['data']):
+                    groups[mid] = mg.metadata[cat]['data'][field]
+                    break
+        if len(groups) == 0:
+            sys.stderr.write("field '%s' does not exist\n"%field)
+        return groups
+
     def metadata_fields(self, table=True):
         tdata = []
         mdata = dict([(x, set()) for x in Ipy.MD_CATS])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import numpy as np
+import scipy.sparse as sp
+from fpcache import FingerprintCache
+
+INDICES = ['richness', 'shannon', 'simpson', 'chao1', 'ace', 'pielou']
+CACHE_SIZE = 32
+
+_cache = FingerprintCache(CACHE_SIZE)  # (fingerprint, rare) -> results
+
+def alpha_indices(matrix, rare=10):
+    """diversity indices of every column (sample) of a count matrix (rows x cols), in one pass:
+        richness : observed annotations
+        shannon  : H = -sum p ln p
+        simpson  : 1 - sum p^2
+        chao1    : bias-corrected, S + F1(F1-1) / 2(F2+1)
+        ace      : abundance coverage estimator, counts <= rare are rare, chao1 when coverage is 0
+        pielou   : H / ln S
+    returns dict of index name -> read-only numpy array of column values
+    results are cached by matrix fingerprint"""
+    return _cache.get(matrix, rare, lambda: _compute(matrix, rare))
+
+def extend_cache(old, new):
+    """seed cached indices of count matrix new from those of matrix old, where new holds
+    the columns of old (zero valued rows may be appended) followed by added columns:
+    only the added columns are computed"""
+    def merge(rare, result):
+        added = _compute(new[:,old.shape[1]:], rare)
+        return dict( (name, np.concatenate([values, added[name]])) for name, values in result.iteritems() )
+    _cache.extend(old, new, merge)
+
+def clear_cache():
+    _cache.clear()
+
+def _compute(matrix, rare):
+    cells = sp.coo_matrix(matrix)
+    keep  = cells.data > 0
+    col   = cells.col[keep]
+    count = cells.data[keep].astype(float)
+    ncol  = cells.shape[1]
+    colsum = lambda w: np.bincount(col, weights=w, minlength=ncol)
+
+    richness = np.bincount(col, minlength=ncol).astype(float)
+    total = colsum(count)
+    prob  = count / total[col]
+    shannon = colsum(-prob * np.log(prob))
+    simpson = np.where(total > 0, 1 - colsum(prob * prob), 0)
+
+    f1 = colsum(count == 1)
+    f2 = colsum(count == 2)
+    chao1 = richness + (f1 * (f1 - 1)) / (2 * (f2 + 1))
+
+    israre = count <= rare
+    s_rare = colsum(israre)
+    n_rare = colsum(np.where(israre, count, 0))
+    pairs  = colsum(np.where(israre, count * (count - 1), 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coverage = 1 - f1 / n_rare
+        gamma = np.maximum((s_rare / coverage) * pairs / (n_rare * (n_rare - 1)) - 1, 0)
+        ace = (richness - s_rare) + (s_rare / coverage) + (f1 / coverage) * gamma
+        pielou = shannon / np.log(richness)
+        ace = np.where((n_rare > 1) & (coverage > 0), ace, chao1)
+    pielou = np.where(richness > 1, pielou, 0)
+    return { 'richness': richness,
+             'shannon': shannon,
+             'simpson': simpson,
+             'chao1': chao1,
+             'ace': ace,
+             'pielou': pielou }
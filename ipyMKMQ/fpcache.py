@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+from collections import OrderedDict
+
+def fingerprint(matrix):
+    """sha1 of a numpy array or scipy sparse matrix shape, type and values"""
+    digest = hashlib.sha1(str(matrix.shape))
+    if sp.issparse(matrix):
+        matrix = sp.csr_matrix(matrix)
+        parts = [matrix.data, matrix.indices, matrix.indptr]
+    else:
+        parts = [np.asarray(matrix)]
+    for part in parts:
+        digest.update(part.dtype.str)
+        digest.update(np.ascontiguousarray(part))
+    return digest.hexdigest()
+
+class FingerprintCache(object):
+    """least recently used cache of results computed from a matrix, keyed on (fingerprint, option)
+    results are numpy arrays or dicts of them, stored and returned read-only"""
+    def __init__(self, size):
+        self.size  = size
+        self._items = OrderedDict()  # oldest first
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def get(self, matrix, option, compute):
+        """cached result for matrix and option, else compute() is called and its result cached"""
+        key = (fingerprint(matrix), option)
+        if key in self._items:
+            self._items[key] = self._items.pop(key)
+            return self._items[key]
+        result = compute()
+        self._put(key, result)
+        return result
+
+    def extend(self, old, new, merge):
+        """seed results of matrix new from the cached results of matrix old:
+        merge(option, result) returns the result for new, or None if it can not be derived"""
+        okey = fingerprint(old)
+        nkey = None
+        for (key, option), result in self._items.items():
+            if key != okey:
+                continue
+            merged = merge(option, result)
+            if merged is None:
+                continue
+            nkey = nkey or fingerprint(new)
+            self._put((nkey, option), merged)
+
+    def clear(self):
+        self._items.clear()
+
+    def _put(self, key, result):
+        for values in (result.itervalues() if isinstance(result, dict) else [result]):
+            values.setflags(write=False)
+        self._items[key] = result
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
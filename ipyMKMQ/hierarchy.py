@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import os, sys, json, urllib
+from collections import defaultdict
+
+class Hierarchy(object):
+    """In-memory parent / child index of the M5NR taxonomy or ontology tree:
+        htype  : 'taxonomy' or 'ontology'
+        levels : hierarchy levels, top first (Ipy.TAX_SET or Ipy.ONT_SET)
+        cfile  : json file the index is persisted to, downloaded once if missing
+
+    Lookups (children, lineage, names) are answered locally from the index.
+    A name can sit under several parents (ontology functions in several subsystems),
+    lineages() gives every path to it, lineage() the first one.
+    A download with failed requests is kept in memory but not saved to cfile.
+    """
+    def __init__(self, htype='taxonomy', cfile=None):
+        self.htype  = 'taxonomy' if htype == 'organism' else 'ontology' if htype == 'function' else htype
+        self.levels = _tools().Ipy.TAX_SET if self.htype == 'taxonomy' else _tools().Ipy.ONT_SET
+        self.cfile  = cfile
+        self._parent   = defaultdict(set)  # (level index, name) -> parent names
+        self._children = defaultdict(set)  # (level index, name) -> child names
+        self._names    = defaultdict(set)  # level index -> names
+        self.failed    = 0  # requests that failed in the last download
+
+    def __len__(self):
+        return len(self._parent)
+
+    def load(self, refresh=False, workers=8):
+        """load index from cfile, or download the full tree and save it"""
+        if self.cfile and os.path.isfile(self.cfile) and (not refresh):
+            try:
+                self._set_edges(json.load(open(self.cfile, 'rU'))['edges'])
+                if _tools().Ipy.DEBUG:
+                    sys.stdout.write("%s index loaded from %s\n"%(self.htype, self.cfile))
+                return len(self) > 0
+            except (IOError, ValueError, KeyError):
+                pass
+        self.failed = self._download(workers)
+        if self.failed:
+            sys.stderr.write("Error: %d requests failed loading %s index, it is incomplete and not saved\n"%(self.failed, self.htype))
+        elif self.cfile and (len(self) > 0):
+            try:
+                json.dump({'htype': self.htype, 'levels': self.levels, 'edges': self.edges()}, open(self.cfile, 'w'))
+            except IOError:
+                sys.stderr.write("Error saving %s index to %s\n"%(self.htype, self.cfile))
+        return len(self) > 0
+
+    def add_lineages(self, lineages):
+        """add full lineages (lists of names, top level first) to the index"""
+        for lineage in lineages:
+            for i, name in enumerate(lineage[:len(self.levels)]):
+                if not name:
+                    break
+                self._add(i, name, lineage[i-1] if i > 0 else None)
+
+    def edges(self):
+        return [ [k[0], k[1], p] for k, parents in self._parent.iteritems() for p in parents ]
+
+    def names(self, level):
+        """all names at level"""
+        index = self._level_index(level)
+        return sorted(self._names[index]) if index is not None else []
+
+    def children(self, level, parent=None):
+        """names at level that descend from parent, parent may be at any higher level"""
+        index = self._level_index(level)
+        if index is None:
+            return []
+        if parent is None:
+            return sorted(self._names[index])
+        found = set()
+        for pindex in range(index):
+            if (pindex, parent) not in self._parent:
+                continue
+            nodes = set([parent])
+            for i in range(pindex, index):
+                nodes = set( c for n in nodes for c in self._children[(i, n)] )
+            found.update(nodes)
+        return sorted(found)
+
+    def lineage(self, name, level=None):
+        """list of names from top level down to name, or [] if not in index
+        the first of lineages() for names under several parents"""
+        lineages = self.lineages(name, level=level)
+        return lineages[0] if lineages else []
+
+    def lineages(self, name, level=None):
+        """every list of names from top level down to name, sorted, [] if not in index"""
+        indexes = [self._level_index(level)] if level else range(len(self.levels)-1, -1, -1)
+        for index in indexes:
+            if (index is None) or ((index, name) not in self._parent):
+                continue
+            return self._paths(index, name)
+        return []
+
+    def level_of(self, name):
+        """lowest level name is found at"""
+        for index in range(len(self.levels)-1, -1, -1):
+            if (index, name) in self._parent:
+                return self.levels[index]
+        return None
+
+    def parent_level(self, level):
+        return _tools().parent_level(level, htype=self.htype)
+
+    def child_level(self, level):
+        return _tools().child_level(level, htype=self.htype)
+
+    def _level_index(self, level):
+        try:
+            return self.levels.index(level)
+        except ValueError:
+            return None
+
+    def _paths(self, index, name):
+        if (index == 0) or ((index, name) not in self._parent):
+            return [[name]]
+        return [ path + [name] for parent in sorted(self._parent[(index, name)]) for path in self._paths(index-1, parent) ]
+
+    def _add(self, index, name, parent):
+        self._parent[(index, name)].add(parent)
+        self._names[index].add(name)
+        if index > 0:
+            self._children[(index-1, parent)].add(name)
+
+    def _set_edges(self, edges):
+        for index, name, parent in edges:
+            self._add(index, name, parent)
+
+    def _download(self, workers):
+        # the api only returns names, walk down the tree one level at a time
+        # returns number of failed requests
+        tools = _tools()
+        top = get_remote(self.htype, self.levels[0])
+        if top is None:
+            return 1
+        failed = 0
+        for name in top:
+            self._add(0, name, None)
+        for index in range(1, len(self.levels)):
+            parents = sorted(self._names[index-1])
+            level = self.levels[index]
+            progress = lambda done, total, item: sys.stdout.write("\rloading %s index, %s: %d of %d"%(self.htype, level, done, total))
+            results = tools.pool_map(lambda x: get_remote(self.htype, level, x), parents, workers=workers, progress=progress)
+            sys.stdout.write("\n")
+            for parent, res in zip(parents, results):
+                # obj_from_url reports the error and returns None
+                if (res[1] is not None) or (res[0] is None):
+                    failed += 1
+                    continue
+                for name in res[0]:
+                    self._add(index, name, parent)
+        return failed
+
+def get_remote(htype, level, parent=None):
+    """names at level (under parent) from the m5nr api"""
+    params = [('min_level', level)]
+    if parent is not None:
+        params.append(('parent_name', parent))
+    return _tools().obj_from_url(_tools().Ipy.API_URL+'m5nr/'+htype+'?'+urllib.urlencode(params, True))
+
+def _tools():
+    # imported on use, ipyTools imports this module
+    import ipyTools
+    return ipyTools
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import httplib, urllib, urlparse, socket, threading, base64
+from Queue import Queue, Empty, Full
+
+class HttpPool(object):
+    """Keep-alive HTTP transport, idle connections are reused per host:
+        size    : max number of idle connections kept open per host
+        timeout : default per-request socket timeout in seconds
+        proxies : dict of scheme -> proxy url, default from http_proxy / https_proxy
+                  environment variables (no_proxy hosts are connected to directly)
+    http requests through a proxy send the absolute url to it, https requests
+    tunnel through it with CONNECT.
+    """
+    def __init__(self, size=8, timeout=300, proxies=None):
+        self.size    = size
+        self.timeout = timeout
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self._pools  = {}
+        self._lock   = threading.Lock()
+
+    def request(self, url, headers={}, timeout=None, redirects=5):
+        """GET url, returns tuple of (http status, response body)
+        the body is always read fully so the connection can go back to the pool"""
+        if timeout is None:
+            timeout = self.timeout
+        parts = urlparse.urlsplit(url)
+        path  = (parts.path or '/') + ('?'+parts.query if parts.query else '')
+        hdrs  = dict(headers)
+        hdrs['Connection'] = 'keep-alive'
+        proxy = self._proxy(parts.scheme, parts.hostname)
+        if proxy and (parts.scheme == 'http'):
+            # plain http proxies take the absolute url
+            path = urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path or '/', parts.query, ''))
+            if proxy[1]:
+                hdrs['Proxy-Authorization'] = proxy[1]
+        key = (parts.scheme, parts.netloc, proxy)
+        for attempt in (0, 1):
+            conn, reused = self._get_conn(key, timeout)
+            try:
+                conn.request('GET', path, None, hdrs)
+                res  = conn.getresponse()
+                body = res.read()
+            except socket.timeout:
+                conn.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # server dropped an idle keep-alive connection, retry once on a fresh one
+                if reused and (attempt == 0):
+                    continue
+                raise
+            if res.will_close:
+                conn.close()
+            else:
+                self._put_conn(key, conn)
+            location = res.getheader('location')
+            if (res.status in (301, 302, 303, 307)) and location and (redirects > 0):
+                return self.request(urlparse.urljoin(url, location), headers=headers, timeout=timeout, redirects=redirects-1)
+            return res.status, body
+
+    def close(self):
+        """close all idle connections"""
+        with self._lock:
+            pools = self._pools.values()
+            self._pools = {}
+        for queue in pools:
+            while True:
+                try:
+                    queue.get_nowait().close()
+                except Empty:
+                    break
+
+    def _proxy(self, scheme, hostname):
+        """(proxy host, Proxy-Authorization header or None) for scheme, None if not proxied"""
+        if (scheme not in self.proxies) or (hostname and urllib.proxy_bypass(hostname)):
+            return None
+        proxy = urlparse.urlsplit(self.proxies[scheme])
+        if not proxy.hostname:
+            # proxy given without scheme, as host:port
+            proxy = urlparse.urlsplit('http://'+self.proxies[scheme])
+        host = proxy.hostname + (':%d'%proxy.port if proxy.port else '')
+        auth = None
+        if proxy.username:
+            creds = urllib.unquote(proxy.username)+':'+urllib.unquote(proxy.password or '')
+            auth  = 'Basic '+base64.b64encode(creds)
+        return host, auth
+
+    def _queue(self, key):
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = Queue(self.size)
+            return self._pools[key]
+
+    def _get_conn(self, key, timeout):
+        scheme, host, proxy = key
+        try:
+            conn = self._queue(key).get_nowait()
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        except Empty:
+            if (scheme == 'https') and proxy:
+                conn = httplib.HTTPSConnection(proxy[0], timeout=timeout)
+                conn.set_tunnel(host, headers={'Proxy-Authorization': proxy[1]} if proxy[1] else None)
+                return conn, False
+            if scheme == 'https':
+                return httplib.HTTPSConnection(host, timeout=timeout), False
+            return httplib.HTTPConnection(proxy[0] if proxy else host, timeout=timeout), False
+
+    def _put_conn(self, key, conn):
+        try:
+            self._queue(key).put_nowait(conn)
+        except Full:
+            conn.close()
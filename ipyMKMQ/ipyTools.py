@@ -2,9 +2,20 @@
 
 from time import localtime, strftime
 from collections import defaultdict
-import os, sys, urllib, urllib2, json, pickle, copy
+import os, sys, urllib, httplib, socket, json, pickle, copy
 import string, random, re
-import rpy2.robjects as ro
+import numpy as np
+import scipy.sparse as sp
+try:
+    import rpy2.robjects as ro
+except ImportError:
+    ro = None
+from multiprocessing.pool import ThreadPool
+from httppool import HttpPool
+from respcache import ResponseCache
+from hierarchy import Hierarchy
+from annotindex import AnnotationIndex
+import hierarchy
 import retina, flotplot
 
 # class for ipy lib env
@@ -12,7 +23,11 @@ class Ipy(object):
     """Constants for ipy-qmqc library interface"""
     FL_PLOT = None
     RETINA  = None
+    HTTP    = HttpPool()
+    CACHE   = None
+    HIER    = {}
     DEBUG   = False
+    USE_R   = False
     NB_DIR  = None
     LIB_DIR = None
     TMP_DIR = None
@@ -21,6 +36,7 @@ class Ipy(object):
     VALUES  = ['abundance', 'evalue', 'identity', 'length']
     TAX_SET = ['domain', 'phylum', 'class', 'order', 'family', 'genus', 'species']
     ONT_SET = ['level1', 'level2', 'level3', 'function']
+    AGG_SET = ['sum', 'mean', 'median']
     MD_CATS = ['project', 'sample', 'library', 'env_package']
     MATRIX  = { 'annotation': 'organism',
                 'level': 'strain',
@@ -65,7 +81,7 @@ class Ipy(object):
                 "#0c5922",
                 "#743411" ]
 
-def init_ipy(debug=False, nb_dir=None, api_url=None):
+def init_ipy(debug=False, nb_dir=None, api_url=None, pool_size=8, timeout=300, cache=True, cache_ttl=604800, cache_size=1073741824, use_r=False):
     # set pathing
     if nb_dir and os.path.isdir(nb_dir):
         Ipy.NB_DIR = nb_dir
@@ -75,20 +91,27 @@ def init_ipy(debug=False, nb_dir=None, api_url=None):
     Ipy.TMP_DIR = Ipy.NB_DIR+'/tmp'
     Ipy.CCH_DIR = Ipy.NB_DIR+'/cache'
     Ipy.IMG_DIR = Ipy.NB_DIR+'/images'
-    for d in (Ipy.LIB_DIR, Ipy.TMP_DIR, Ipy.IMG_DIR):
+    for d in (Ipy.LIB_DIR, Ipy.TMP_DIR, Ipy.CCH_DIR, Ipy.IMG_DIR):
         if not os.path.isdir(d):
             os.mkdir(d)
     # set api
     if api_url is not None:
         Ipy.API_URL = api_url
+    # set shared keep-alive connections
+    Ipy.HTTP.close()
+    Ipy.HTTP = HttpPool(size=pool_size, timeout=timeout)
+    # set api response cache
+    Ipy.CACHE = ResponseCache(Ipy.CCH_DIR+'/api', ttl=cache_ttl, max_bytes=cache_size) if cache else None
     # set graphing tools
     Ipy.FL_PLOT = flotplot.FlotPlot()
     Ipy.RETINA  = retina.Retina()
     Ipy.DEBUG   = debug
+    Ipy.USE_R   = use_r
     # load matR and extras
-    ro.r('suppressMessages(library(matR))')
-    ro.r('suppressMessages(library(gplots))')
-    ro.r('suppressMessages(library(scatterplot3d))')
+    if ro is not None:
+        ro.r('suppressMessages(library(matR))')
+        ro.r('suppressMessages(library(gplots))')
+        ro.r('suppressMessages(library(scatterplot3d))')
     # echo
     if Ipy.DEBUG:
         for k in Ipy.__dict__.keys():
@@ -121,32 +144,107 @@ def google_palette(num):
         num_colors.append( Ipy.COLORS[c_index] )
     return num_colors
 
-def obj_from_url(url):
+def obj_from_url(url, timeout=None, cache=True, raise_errors=False):
+    """returns json object from url, or None on error (written to stderr)
+    raise_errors: raise IOError with the error message instead"""
     if Ipy.DEBUG:
         sys.stdout.write(url+"\n")
+    if cache and Ipy.CACHE:
+        body = Ipy.CACHE.get(url)
+        if body is not None:
+            return json.loads(body)
     try:
-        req = urllib2.Request(url, headers={'Accept': 'application/json'})
-        res = urllib2.urlopen(req)
-    except urllib2.HTTPError, error:
-        sys.stderr.write("ERROR (%s): %s\n"%(url, error.read()))
-        return None
-    if not res:
-        sys.stderr.write("ERROR (%s): no results returned\n"%url)
-        return None
-    obj = json.loads(res.read())
+        status, body = Ipy.HTTP.request(url, headers={'Accept': 'application/json'}, timeout=timeout)
+    except (httplib.HTTPException, socket.error), error:
+        return _url_error(url, error, raise_errors)
+    if status >= 400:
+        return _url_error(url, body, raise_errors)
+    if not body:
+        return _url_error(url, "no results returned", raise_errors)
+    obj = json.loads(body)
     if not obj:
-        sys.stderr.write("ERROR (%s): return structure not valid json format\n"%url)
-        return None
+        return _url_error(url, "return structure not valid json format", raise_errors)
     if 'ERROR' in obj:
-        sys.stderr.write("ERROR (%s): %s"%(url, obj['ERROR']))
-        return None
+        return _url_error(url, obj['ERROR'], raise_errors)
+    if cache and Ipy.CACHE:
+        Ipy.CACHE.put(url, body)
     return obj
 
+def _url_error(url, error, raise_errors):
+    if raise_errors:
+        raise IOError("%s: %s"%(url, error))
+    sys.stderr.write("ERROR (%s): %s\n"%(url, error))
+    return None
+
+def pool_map(func, items, workers=1, progress=None):
+    """apply func to each item using a bounded thread pool of size workers
+    progress is called as progress(done, total, item) when each item finishes
+    returns list of [result, error] in input order, error is None on success"""
+    def run(indexed):
+        try:
+            return indexed[0], [func(indexed[1]), None]
+        except Exception, error:
+            return indexed[0], [None, "%s: %s"%(error.__class__.__name__, error)]
+    results = [None for x in items]
+    indexed = list(enumerate(items))
+    pool = ThreadPool(min(workers, len(items))) if (workers > 1) and (len(items) > 1) else None
+    try:
+        finished = pool.imap_unordered(run, indexed) if pool else (run(x) for x in indexed)
+        for done, res in enumerate(finished):
+            results[res[0]] = res[1]
+            if progress:
+                progress(done+1, len(items), items[res[0]])
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return results
+
 def slice_column(matrix, index):
-    data = []
-    for row in matrix:
-        data.append(row[index])
-    return data
+    return np.asarray(matrix)[:,index].tolist()
+
+def json_default(obj):
+    """json.dump default for numpy arrays and scalars, sparse matrices become biom [row, col, value] lists"""
+    if sp.issparse(obj):
+        coo = obj.tocoo()
+        return zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist())
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("%s is not JSON serializable"%repr(obj))
+
+def biom_data(matrix):
+    """biom list form of a typed matrix: list of rows, or [row, col, value] lists if sparse
+    biom functions that take typed=True leave data as the typed matrix (see biom_matrix) and skip this step,
+    which is faster but the biom is no longer JSON serializable without ipyTools.json_default"""
+    if sp.issparse(matrix):
+        coo = matrix.tocoo()
+        return map(list, zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist()))
+    return np.asarray(matrix).tolist()
+
+def matrix_dtype(b):
+    """numpy dtype for biom matrix_element_type"""
+    return np.int64 if b.get('matrix_element_type') == 'int' else np.float64
+
+def biom_matrix(b):
+    """returns biom data as matrix (rows x cols), no copy if already typed:
+    scipy csr matrix for sparse bioms, numpy array for dense bioms"""
+    if b['matrix_type'] == 'sparse':
+        return sparse_to_csr(b['data'], b['shape'][0], b['shape'][1], dtype=matrix_dtype(b))
+    return np.asarray(b['data'], dtype=matrix_dtype(b)).reshape(b['shape'][0], b['shape'][1])
+
+def to_dense(matrix):
+    """numpy array of a dense or sparse matrix"""
+    return matrix.toarray() if sp.issparse(matrix) else np.asarray(matrix)
+
+def sub_block(matrix, rows, cols):
+    """dense numpy array of row and column indexes of a dense or sparse matrix"""
+    if sp.issparse(matrix):
+        return matrix[rows][:,cols].toarray()
+    return matrix[np.ix_(rows, cols)]
+
+def axis_sum(matrix, axis):
+    """sums along axis of a dense or sparse matrix as flat numpy array"""
+    return np.asarray(matrix.sum(axis=axis)).ravel()
 
 def toNum(s):
     s = str(s)
@@ -180,48 +278,49 @@ def ordered_distance_from_file(fname):
     fhdl.close()
     return order_dist, dist_matrix
 
-def sparse_to_dense(sMatrix, rmax, cmax):
-    dMatrix = [[0 for i in range(cmax)] for j in range(rmax)]
-    for sd in sMatrix:
-        r, c, v = sd
-        dMatrix[r][c] = v
+def sparse_to_dense(sMatrix, rmax, cmax, dtype=np.int64):
+    if sp.issparse(sMatrix):
+        return sMatrix.toarray()
+    dMatrix = np.zeros((rmax, cmax), dtype=dtype)
+    if len(sMatrix) > 0:
+        sArray = np.asarray(sMatrix)
+        dMatrix[sArray[:,0].astype(int), sArray[:,1].astype(int)] = sArray[:,2]
     return dMatrix
 
+def sparse_to_csr(sMatrix, rmax, cmax, dtype=np.int64):
+    """csr matrix from biom sparse [row, col, value] list, no copy if already csr"""
+    if sp.isspmatrix_csr(sMatrix) and (sMatrix.dtype == dtype):
+        return sMatrix
+    if sp.issparse(sMatrix):
+        return sMatrix.tocsr().astype(dtype)
+    if len(sMatrix) == 0:
+        return sp.csr_matrix((rmax, cmax), dtype=dtype)
+    sArray = np.asarray(sMatrix)
+    return sp.csr_matrix((sArray[:,2].astype(dtype), (sArray[:,0].astype(int), sArray[:,1].astype(int))), shape=(rmax, cmax))
+
 def pyMatrix_to_rMatrix(matrix, rmax, cmax, normalize=0):
-    if (not matrix) or (len(matrix) == 0):
+    if (ro is None) or (matrix is None) or (np.size(matrix) == 0):
         return None
-    mList = []
-    for i in range(cmax):
-        if normalize:
-            cList = map(lambda x: float(x[i]), matrix)
-        else:
-            cList = map(lambda x: int(x[i]), matrix)
-        mList.extend(cList)
+    # R matrices are column-major
+    mList = np.asarray(matrix).ravel(order='F')
     if normalize:
-        return ro.r.matrix(ro.FloatVector(mList), nrow=rmax)
+        return ro.r.matrix(ro.FloatVector(mList.astype(float).tolist()), nrow=rmax)
     else:
-        return ro.r.matrix(ro.IntVector(mList), nrow=rmax)
+        return ro.r.matrix(ro.IntVector(mList.astype(int).tolist()), nrow=rmax)
 
 def rMatrix_to_pyMatrix(matrix, rmax, cmax):
     if (not matrix) or (len(matrix) == 0):
         return None
-    pyM = [[0 for i in range(cmax)] for j in range(rmax)]
-    col = 0
-    for i in range(len(matrix)):
-        row = i - (rmax * col)
-        pyM[row][col] = matrix[i] 
-        if row == (rmax-1):
-            col += 1
-    return pyM
+    return np.array(list(matrix), dtype=float).reshape((rmax, cmax), order='F')
 
 def random_str(size=8):
     chars = string.ascii_letters + string.digits
     return ''.join(random.choice(chars) for x in range(size))
 
-def sub_biom(b, text):
-    str_re = re.compile(text, re.IGNORECASE)
+def sub_biom(b, text, index=None, typed=False):
+    """biom of rows whose id or hierarchy leaf name matches text (regex, case-insensitive), index: AnnotationIndex of b rows"""
     sBiom = { "generated_by": b['generated_by'],
-               "matrix_type": 'dense',
+               "matrix_type": b['matrix_type'],
                "date": strftime("%Y-%m-%dT%H:%M:%S", localtime()),
                "data": [],
                "rows": [],
@@ -238,166 +337,226 @@ def sub_biom(b, text):
         hier = 'taxonomy'
     elif b['type'].startswith('Function'):
         hier = 'ontology'
+    if index is None:
+        index = AnnotationIndex(b['rows'], hier)
+    leaf = index.search(text, fields=['leaf'])
+    rows = np.union1d(leaf, index.search(text, fields=['id']))
+    leaf = set(leaf.tolist())
     seen = set()
-    matrix = b['data'] if b['matrix_type'] == 'dense' else sparse_to_dense(b['data'], b['shape'][0], b['shape'][1])
-    for r, row in enumerate(b['rows']):
-        name = None
-        if row['metadata'] and hier and (hier in row['metadata']) and str_re.search(row['metadata'][hier][-1]):
-            name = row['metadata'][hier][-1]
-        elif str_re.search(row['id']):
-            name = row['id']
-        if (name is not None) and (name not in seen):
-            sBiom['data'].append(matrix[r])
+    rIndex = []
+    for r in rows:
+        row  = b['rows'][r]
+        name = row['metadata'][hier][-1] if r in leaf else row['id']
+        if name not in seen:
+            rIndex.append(r)
             sBiom['rows'].append(row)
             seen.add(name)
+    sBiom['data']  = biom_matrix(b)[rIndex]
     sBiom['shape'] = [len(sBiom['rows']), b['shape'][1]]
-    return biom_remove_empty(sBiom)
+    return biom_remove_empty(sBiom, typed=typed)
+
+def rollup_biom(b, level, typed=False):
+    """abundance biom of a coarser hierarchy level, summed from the lineage metadata of a finer level biom"""
+    hier, levels = '', []
+    if b['type'].startswith('Taxon'):
+        hier, levels = 'taxonomy', Ipy.TAX_SET
+    elif b['type'].startswith('Function'):
+        hier, levels = 'ontology', Ipy.ONT_SET
+    if level not in levels:
+        sys.stderr.write("Error: can not roll up %s biom to level '%s'\n"%(b['type'], level))
+        return None
+    if b['matrix_element_value'] != 'abundance':
+        sys.stderr.write("Error: only abundance can be rolled up, not %s\n"%b['matrix_element_value'])
+        return None
+    depth = levels.index(level)
+    rBiom = { "generated_by": b['generated_by'],
+               "matrix_type": b['matrix_type'],
+               "date": strftime("%Y-%m-%dT%H:%M:%S", localtime()),
+               "data": [],
+               "rows": [],
+               "matrix_element_value": b['matrix_element_value'],
+               "matrix_element_type": b['matrix_element_type'],
+               "format_url": "http://biom-format.org",
+               "format": "Biological Observation Matrix 1.0",
+               "columns": b['columns'],
+               "id": b['id']+'_'+level,
+               "type": b['type'],
+               "shape": [] }
+    groups = {}
+    index, member = [], []
+    for r, row in enumerate(b['rows']):
+        # rows without lineage are dropped, unnamed levels are named after their parent
+        if not (row['metadata'] and (hier in row['metadata']) and (len(row['metadata'][hier]) > depth)):
+            continue
+        lineage = list(row['metadata'][hier][:depth+1])
+        if not lineage[-1]:
+            named = filter(None, lineage)
+            lineage[-1] = "unclassified (derived from %s)"%named[-1] if named else "unclassified"
+        if lineage[-1] not in groups:
+            groups[lineage[-1]] = len(rBiom['rows'])
+            rBiom['rows'].append({'id': lineage[-1], 'metadata': {hier: lineage}})
+        index.append(r)
+        member.append(groups[lineage[-1]])
+    # group x row indicator matrix, product sums the rows of each group
+    indicator = sp.csr_matrix((np.ones(len(index), dtype=matrix_dtype(b)), (member, index)), shape=(len(rBiom['rows']), b['shape'][0]))
+    matrix = indicator * biom_matrix(b)
+    matrix = sp.csr_matrix(matrix) if b['matrix_type'] == 'sparse' else np.asarray(matrix)
+    rBiom['data']  = matrix if typed else biom_data(matrix)
+    rBiom['shape'] = [len(rBiom['rows']), b['shape'][1]]
+    return rBiom
 
-def merge_cols(b, merge_set):
-    """input: biom object, merge_set -> { merge_name_1 : [list of col ids], merge_name_2 : [list of col ids], ... }"""
+def merge_cols(b, merge_set, method='sum', typed=False):
+    """input: biom object, merge_set -> { merge_name_1 : [list of col ids], merge_name_2 : [list of col ids], ... }, method in Ipy.AGG_SET"""
     if not (merge_set and (len(merge_set) > 0)):
         sys.stderr.write("No merge set inputted\n")
         return None
-    new_data = []
+    if method not in Ipy.AGG_SET:
+        sys.stderr.write("Invalid merge method '%s', use one of: %s\n"%(method, ", ".join(Ipy.AGG_SET)))
+        return None
+    cpos = dict( (c['id'], j) for j, c in enumerate(b['columns']) )
     new_cols = []
-    seen = []
-    # create new col set / test for duplicate merge ids
-    for name, ids in merge_set.iteritems():
-        if [i for i in ids if i in seen]:
+    members  = []  # input column positions of each new column
+    seen = set()
+    # create new col set (sorted by name) / test for duplicate merge ids
+    for name in sorted(merge_set):
+        index = [ cpos[i] for i in merge_set[name] if i in cpos ]
+        if seen.intersection(index):
             sys.stderr.write("Can not merge same column in more than 1 group\n")
             return None
-        seen.extend(ids)
-        new_cols.append({'id': name, 'name': name, 'metadata': {'components': ids}})
+        if len(index) == 0:
+            sys.stderr.write("No columns of merge set %s in %s\n"%(name, b['id']))
+            continue
+        seen.update(index)
+        new_cols.append({'id': name, 'name': name, 'metadata': {'components': [ b['columns'][j]['id'] for j in index ]}})
+        members.append(index)
     # add singlets
-    for c in b['columns']:
-        if c['id'] not in seen:
+    for j, c in enumerate(b['columns']):
+        if j not in seen:
             new_cols.append(c)
-    # merge cols in data
-    for row in b['data']:
-        row_map = dict([(x['id'], 0) for x in new_cols])
-        new_row = []
-        for c, col in enumerate(b['columns']):
-            if col['id'] in new_cols:
-                row_map[col['id']] = row[c]
-            else:
-                for name, ids in merge_set.iteritems():
-                    if col['id'] in ids:
-                        row_map[name] += row[c]
-                        break
-        # re-order row
-        for col in new_cols:
-            new_row.append( row_map[col['id']] )
-        new_data.append(new_row)
-    new_b = copy.deepcopy(b)
+            members.append([j])
+    matrix = biom_matrix(b)
+    if method == 'median':
+        # per group over all rows at once, only one group of columns dense at a time
+        merged = np.column_stack([ np.median(to_dense(matrix[:,index]), axis=1) for index in members ])
+    else:
+        # column x group indicator, weighted 1 / group size for mean
+        sizes  = np.array(map(len, members), dtype=float)
+        cols   = np.concatenate(members)
+        groups = np.repeat(np.arange(len(members)), sizes.astype(int))
+        weight = np.ones(len(cols)) if method == 'sum' else 1 / sizes[groups]
+        indicator = sp.csr_matrix((weight, (cols, groups)), shape=(len(b['columns']), len(members)))
+        merged = matrix * indicator
+    etype = b['matrix_element_type'] if (method == 'sum') else 'float'
+    dtype = np.int64 if etype == 'int' else np.float64
+    # rows are shared with the input biom, not copied
+    new_b = dict(b)
+    new_b['id'] = b['id']+'_merged'
+    new_b['date'] = strftime("%Y-%m-%dT%H:%M:%S", localtime())
     new_b['columns'] = new_cols
-    new_b['data'] = new_data
+    new_b['matrix_element_type'] = etype
+    merged = sp.csr_matrix(merged, dtype=dtype) if b['matrix_type'] == 'sparse' else to_dense(merged).astype(dtype)
+    new_b['data']  = merged if typed else biom_data(merged)
+    new_b['shape'] = [ len(b['rows']), len(new_cols) ]
     return new_b
 
-def merge_biom(b1, b2):
-    if b1 and b2 and (b1['type'] == b2['type']) and (b1['matrix_type'] == b2['matrix_type']) and (b1['matrix_element_type'] == b2['matrix_element_type']) and (b1['matrix_element_value'] == b2['matrix_element_value']):
-        mBiom = { "generated_by": b1['generated_by'],
-                   "matrix_type": 'dense',
-                   "date": strftime("%Y-%m-%dT%H:%M:%S", localtime()),
-                   "data": [],
-                   "rows": [],
-                   "matrix_element_value": b1['matrix_element_value'],
-                   "matrix_element_type": b1['matrix_element_type'],
-                   "format_url": "http://biom-format.org",
-                   "format": "Biological Observation Matrix 1.0",
-                   "columns": [],
-                   "id": b1['id']+'_'+b2['id'],
-                   "type": b1['type'],
-                   "shape": [] }
-        cols, rows = merge_matrix_info(b1['columns'], b2['columns'], b1['rows'], b2['rows'])
-        merge_func = merge_sparse if b1['matrix_type'] == 'sparse' else merge_dense
-        mCol, mRow, mData = merge_func([b1['data'], b2['data']], cols, rows)
-        mBiom['columns']  = mCol
-        mBiom['rows']     = mRow
-        mBiom['data']     = mData
-        mBiom['shape']    = [ len(mRow), len(mCol) ]
-        return biom_remove_empty(mBiom)
-    else:
-        sys.stderr.write("The inputed biom objects are not compatable for merging\n")
+def merge_biom(*bioms, **kwargs):
+    """merge bioms of the same type, matrix type and values into one biom, rows with the same id are summed"""
+    if (len(bioms) < 2) or (not all(bioms)):
+        sys.stderr.write("At least two biom objects are required for merging\n")
         return None
+    b1 = bioms[0]
+    for b in bioms[1:]:
+        if not ((b1['type'] == b['type']) and (b1['matrix_type'] == b['matrix_type']) and (b1['matrix_element_type'] == b['matrix_element_type']) and (b1['matrix_element_value'] == b['matrix_element_value'])):
+            sys.stderr.write("The inputed biom objects are not compatable for merging\n")
+            return None
+    mBiom = { "generated_by": b1['generated_by'],
+               "matrix_type": b1['matrix_type'],
+               "date": strftime("%Y-%m-%dT%H:%M:%S", localtime()),
+               "data": [],
+               "rows": [],
+               "matrix_element_value": b1['matrix_element_value'],
+               "matrix_element_type": b1['matrix_element_type'],
+               "format_url": "http://biom-format.org",
+               "format": "Biological Observation Matrix 1.0",
+               "columns": [],
+               "id": "_".join(map(lambda x: x['id'], bioms)),
+               "type": b1['type'],
+               "shape": [] }
+    # joined on ids, data is merged as sparse coordinate values and only densified once merged
+    rpos, cpos = {}, {}
+    mRows, mCols, mVals = [], [], []
+    for b in bioms:
+        # position in merged matrix of each row, and of each column this biom owns (else -1)
+        rmap = np.empty(len(b['rows']), dtype=np.int64)
+        for i, r in enumerate(b['rows']):
+            if r['id'] not in rpos:
+                rpos[r['id']] = len(mBiom['rows'])
+                mBiom['rows'].append(r)
+            rmap[i] = rpos[r['id']]
+        cmap = np.empty(len(b['columns']), dtype=np.int64)
+        cmap.fill(-1)
+        for j, c in enumerate(b['columns']):
+            if c['id'] not in cpos:
+                cpos[c['id']] = len(mBiom['columns'])
+                mBiom['columns'].append(c)
+                cmap[j] = cpos[c['id']]
+        coo  = sp.coo_matrix(biom_matrix(b))
+        keep = cmap[coo.col] >= 0
+        mRows.append(rmap[coo.row[keep]])
+        mCols.append(cmap[coo.col[keep]])
+        mVals.append(coo.data[keep])
+    # duplicate entries are summed
+    shape  = (len(mBiom['rows']), len(mBiom['columns']))
+    matrix = sp.csr_matrix((np.concatenate(mVals), (np.concatenate(mRows), np.concatenate(mCols))), shape=shape, dtype=matrix_dtype(b1))
+    mBiom['data']  = matrix if b1['matrix_type'] == 'sparse' else matrix.toarray()
+    mBiom['shape'] = list(shape)
+    return biom_remove_empty(mBiom, typed=kwargs.get('typed', False))
 
-def merge_matrix_info(c1, c2, r1, r2):
-    ## merge columns, skip duplicate
-    cm = {}
-    for i, c in enumerate(c1):
-        cm[ c['id'] ] = [0, i, c]
-    for i, c in enumerate(c2):
-        if c['id'] in cm:
-            continue
-        cm[ c['id'] ] = [1, i, c]
-    ## merge rows
-    rm = defaultdict(list)
-    for i, r in enumerate(r1):
-        rm[ r['id'] ].append( [0, i, r] )
-    for i, r in enumerate(r2):
-        rm[ r['id'] ].append( [1, i, r] )
-    return cm.values(), rm.values()
-
-def merge_sparse(data, cols, rows):
-    for i in range(len(data)):
-        data[i] = sparse_to_dense(data[i], len(rows), len(cols))
-    return merge_dense(data, cols, rows)
-    
-def merge_dense(data, cols, rows):
-    cm = map(lambda x: x[2], cols)
-    rm = map(lambda x: x[0][2], rows)
-    mm = [[0 for i in range(len(cols))] for j in range(len(rows))]
-    for i, rset in enumerate(rows):
-        for r in rset:
-            for j, c in enumerate(cols):
-                if r[0] == c[0]:
-                    mm[i][j] += data[ r[0] ][ r[1] ][ c[1] ]
-    return cm, rm, mm
-
-def biom_remove_empty(b):
-    vRows = []
-    vCols = []
-    if b['matrix_type'] == 'sparse':
-        b['data'] = sparse_to_dense(b['data'], b['shape'][0], b['shape'][1])
-        b['matrix_type'] = 'dense'
-    for i, r in enumerate(b['rows']):
-        row = b['data'][i]
-        if sum(row) > 0:
-            vRows.append(i)
-    for j, c in enumerate(b['columns']):
-        col = map(lambda x: x[j], b['data'])
-        if sum(col) > 0:
-            vCols.append(j)
-    if len(vRows) < len(b['rows']):
-        sub_rows = []
-        sub_data = []
-        for r in vRows:
-            sub_rows.append(b['rows'][r])
-            sub_data.append(b['data'][r])
-        b['rows'] = sub_rows
-        b['data'] = sub_data
-    if len(vRows) < len(b['columns']):
-        sub_cols = []
-        sub_data = []
-        for c in vCols:
-            sub_cols.append(b['columns'][c])
-        for row in b['data']:
-            sub_row = []
-            for c in vCols:
-                sub_row.append(row[c])
-            sub_data.append(sub_row)
-        b['columns'] = sub_cols
-        b['data'] = sub_data
-    return b
-
-def get_hierarchy(htype='taxonomy', level='species', parent=None):
+def biom_remove_empty(b, report=False, typed=False):
+    """removes rows and columns of biom b without non-zero values, in place, returns b (and removed counts if report)"""
+    matrix = biom_matrix(b)
+    # absolute values, non-abundance values may cancel out
+    nonzero = abs(matrix)
+    vRows = np.flatnonzero(axis_sum(nonzero, 1) > 0)
+    vCols = np.flatnonzero(axis_sum(nonzero, 0) > 0)
+    removed = { 'rows': len(b['rows']) - len(vRows), 'columns': len(b['columns']) - len(vCols) }
+    if removed['rows'] or removed['columns']:
+        b['rows'] = [ b['rows'][r] for r in vRows ]
+        b['columns'] = [ b['columns'][c] for c in vCols ]
+        matrix = matrix[vRows][:,vCols] if sp.issparse(matrix) else matrix[np.ix_(vRows, vCols)]
+        if Ipy.DEBUG:
+            sys.stdout.write("removed %d empty rows and %d empty columns from %s\n"%(removed['rows'], removed['columns'], b['id']))
+    b['data']  = matrix if typed else biom_data(matrix)
+    b['shape'] = [ len(b['rows']), len(b['columns']) ]
+    return (b, removed) if report else b
+
+def get_hierarchy(htype='taxonomy', level='species', parent=None, local=True):
     if htype == 'organism':
         htype = 'taxonomy'
     if htype == 'function':
         htype = 'ontology'
-    params = [('min_level', level)]
-    if parent is not None:
-        params.append(('parent_name', parent))
-    return obj_from_url(Ipy.API_URL+'m5nr/'+htype+'?'+urllib.urlencode(params, True))
+    if local:
+        index = hierarchy_index(htype)
+        # parents missing from the index (stale, or rolled up 'unclassified' names) are asked remotely
+        if (index is not None) and ((parent is None) or (index.level_of(parent) is not None)):
+            return index.children(level, parent)
+    return hierarchy.get_remote(htype, level, parent)
+
+def hierarchy_index(htype='taxonomy', refresh=False):
+    """returns the local M5NR hierarchy index for htype, downloaded once and kept in Ipy.CCH_DIR"""
+    if htype == 'organism':
+        htype = 'taxonomy'
+    if htype == 'function':
+        htype = 'ontology'
+    if (htype not in Ipy.HIER) or refresh:
+        cfile = Ipy.CCH_DIR+'/m5nr_'+htype+'.json' if Ipy.CCH_DIR else None
+        index = Hierarchy(htype=htype, cfile=cfile)
+        Ipy.HIER[htype] = index if index.load(refresh=refresh) else None
+    return Ipy.HIER[htype]
+
+def get_lineage(name, htype='taxonomy', level=None):
+    index = hierarchy_index(htype)
+    return index.lineage(name, level=level) if index else []
 
 def get_taxonomy(level='species', parent=None):
     return get_hierarchy(htype='taxonomy', level=level, parent=parent)
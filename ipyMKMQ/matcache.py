@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import os, json
+import numpy as np
+import scipy.sparse as sp
+
+# bump when the on-disk layout changes
+VERSION = 2
+
+def cache_files(bfile):
+    """binary cache files kept next to biom file bfile:
+        <name>.meta         : json of the biom header and columns, plus source file size / mtime
+        <name>.*.npy        : raw arrays of the data, dense: data, sparse csr: data, indices, indptr
+        <name>.rowids.npy   : row ids, utf-8 strings
+        <name>.lineage.npy  : rows x levels hierarchy names of rows, utf-8 strings ('' for None),
+                              for rows with only a taxonomy / ontology lineage, else rows are in .meta
+    """
+    base = bfile[:-5] if bfile.endswith('.biom') else bfile
+    return { 'meta': base+'.meta',
+             'data': base+'.data.npy',
+             'indices': base+'.indices.npy',
+             'indptr': base+'.indptr.npy',
+             'rowids': base+'.rowids.npy',
+             'lineage': base+'.lineage.npy' }
+
+def load(bfile, mmap=True):
+    """biom from the binary cache of bfile, or None if missing or older than bfile
+    data arrays are memory-mapped read-only, so pages are shared between processes"""
+    files = cache_files(bfile)
+    try:
+        meta = json.load(open(files['meta'], 'rb'))
+        if (meta['version'] != VERSION) or (meta['source'] != _source_stat(bfile)):
+            return None
+        mode = 'r' if mmap else None
+        biom = meta['biom']
+        biom['columns'] = meta['columns']
+        if 'rows' in meta:
+            biom['rows'] = meta['rows']
+        else:
+            ids  = np.load(files['rowids'], mmap_mode=mode)
+            hier = meta['lineage']
+            lineage = np.load(files['lineage'], mmap_mode=mode)
+            biom['rows'] = [ {'id': _text(i), 'metadata': {hier: [ _text(x) or None for x in names ]}} for i, names in zip(ids.tolist(), lineage.tolist()) ]
+        if biom['matrix_type'] == 'sparse':
+            arrays = [ np.load(files[x], mmap_mode=mode) for x in ('data', 'indices', 'indptr') ]
+            biom['data'] = sp.csr_matrix(tuple(arrays), shape=tuple(biom['shape']), copy=False)
+        else:
+            biom['data'] = np.load(files['data'], mmap_mode=mode)
+        return biom
+    except (IOError, OSError, EOFError, ValueError, KeyError, TypeError):
+        return None
+
+def save(bfile, biom, data):
+    """write binary cache of bfile for biom, data is its typed matrix (numpy array or csr)"""
+    files = cache_files(bfile)
+    meta  = { 'version': VERSION,
+              'source': _source_stat(bfile),
+              'biom': dict((k, v) for k, v in biom.iteritems() if k not in ('data', 'rows', 'columns')),
+              'columns': biom['columns'] }
+    if sp.issparse(data):
+        data = sp.csr_matrix(data)
+        arrays = { 'data': data.data, 'indices': data.indices, 'indptr': data.indptr }
+    else:
+        arrays = { 'data': np.ascontiguousarray(data) }
+    hier = _lineage_key(biom['rows'])
+    if hier:
+        meta['lineage'] = hier
+        arrays['rowids']  = _strings([ r['id'] for r in biom['rows'] ])
+        arrays['lineage'] = _strings([ [ x or '' for x in r['metadata'][hier] ] for r in biom['rows'] ])
+    else:
+        meta['rows'] = biom['rows']
+    # arrays first, meta last marks the cache complete. every file is written to a temp
+    # file and renamed, other processes keep their mmap of the replaced file intact
+    for name, array in arrays.iteritems():
+        hdl = _temp_file(files[name])
+        np.save(hdl, array)
+        _replace(hdl, files[name])
+    hdl = _temp_file(files['meta'])
+    json.dump(meta, hdl)
+    _replace(hdl, files['meta'])
+
+def _lineage_key(rows):
+    # hierarchy key if every row is only an id and an equal length lineage of names, else None
+    if (len(rows) == 0) or (not isinstance(rows[0].get('metadata'), dict)) or (len(rows[0]['metadata']) != 1):
+        return None
+    hier  = rows[0]['metadata'].keys()[0]
+    width = len(rows[0]['metadata'][hier] or [])
+    for r in rows:
+        if (len(r) != 2) or (not isinstance(r.get('metadata'), dict)) or (r['metadata'].keys() != [hier]):
+            return None
+        names = r['metadata'][hier]
+        # '' would come back as None
+        if (not isinstance(names, list)) or (len(names) != width) or (not all( (x is None) or (isinstance(x, basestring) and x) for x in names )):
+            return None
+    return hier if width > 0 else None
+
+def _strings(values):
+    # fixed width utf-8 string array
+    values = np.asarray(values, dtype=object)
+    encoded = np.array([ x.encode('utf-8') if isinstance(x, unicode) else str(x) for x in values.ravel() ], dtype=object)
+    width = max([1] + map(len, encoded))
+    return encoded.astype('S%d'%width).reshape(values.shape)
+
+def _text(value):
+    return value.decode('utf-8')
+
+def _temp_file(fname):
+    # same dir, so the rename does not cross file systems
+    return open("%s.%d.tmp"%(fname, os.getpid()), 'wb')
+
+def _replace(hdl, fname):
+    hdl.close()
+    os.rename(hdl.name, fname)
+
+def _source_stat(bfile):
+    st = os.stat(bfile)
+    return [st.st_size, int(st.st_mtime)]
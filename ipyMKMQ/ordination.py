@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy.spatial.distance import squareform
+from scipy.sparse.linalg import eigsh
+
+# largest sample count solved with a full eigen decomposition
+FULL_EIGEN_MAX = 500
+
+def pcoa(dvec, k=None, solver='auto'):
+    """principal coordinates analysis of a condensed distance vector, as ecodist pco() in R/plot_pco.r
+        k      : number of axes to return, default all
+        solver : 'full' eigen decomposition, 'truncated' lanczos for the k largest axes,
+                 or 'auto' (truncated when k is small compared to many samples)
+    returns dict of:
+        values    : eigenvalues, largest first, negative values set to 0
+        explained : eigenvalues scaled by the sum of the non-negative eigenvalues, as plot_pco.r
+                    does after ecodist sets negative eigenvalues to 0. the truncated solver does
+                    not know that sum and uses the trace of the centered matrix, which overstates
+                    the fractions when the distance is not euclidean
+        vectors   : coordinates (samples x k), eigenvectors scaled by sqrt of eigenvalues
+    """
+    dist = squareform(np.asarray(dvec, dtype=float))
+    n = dist.shape[0]
+    k = n if (k is None) or (k > n) else k
+    if n == 0:
+        return {'values': np.zeros(0), 'explained': np.zeros(0), 'vectors': np.zeros((0, 0))}
+    # gower centered matrix of -d^2/2
+    gower = -0.5 * dist * dist
+    gower -= gower.mean(axis=0)
+    gower -= gower.mean(axis=1)[:,None]
+    if solver == 'auto':
+        solver = 'truncated' if (n > FULL_EIGEN_MAX) and (k < n / 10) else 'full'
+    if solver == 'truncated' and (k < n - 1):
+        values, vectors = eigsh(gower, k=k, which='LA')
+    elif solver in ('full', 'truncated'):
+        values, vectors = np.linalg.eigh(gower)
+    else:
+        raise ValueError("invalid eigen solver '%s', use one of: auto, full, truncated"%solver)
+    total   = np.maximum(values, 0).sum() if len(values) == n else np.trace(gower)
+    order   = np.argsort(values)[::-1][:k]
+    values  = np.maximum(values[order], 0)
+    vectors = vectors[:,order]
+    # eigenvector sign is arbitrary, make largest component of each axis positive
+    signs = np.sign(vectors[np.abs(vectors).argmax(axis=0), np.arange(vectors.shape[1])])
+    vectors = vectors * np.where(signs == 0, 1, signs) * np.sqrt(values)
+    return { 'values': values,
+             'explained': values / total if total > 0 else np.zeros(len(values)),
+             'vectors': vectors }
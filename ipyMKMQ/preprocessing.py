@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import numpy as np
+import scipy.sparse as sp
+
+def preprocess(matrix):
+    """Python version of MGRAST_preprocessing (R/preprocessing.r) for a count matrix (rows x cols):
+        1. log2(x+1)
+        2. center each column (sample) by its mean and standard deviation
+        3. shift by the absolute minimum and scale all values from 0 to 1
+    input may be a numpy array or scipy sparse matrix, returns a float numpy array
+    """
+    return preprocess_stats(matrix)[0]
+
+def preprocess_stats(matrix):
+    """preprocess() result and the dict of values it used: column mean and sd (of log values),
+    shift and scale of the final step, needed by extend_preprocessed()"""
+    if sp.issparse(matrix):
+        norm = matrix.toarray().astype(float)
+    else:
+        norm = np.array(matrix, dtype=float)
+    if norm.size == 0:
+        return norm, None
+    norm[np.isnan(norm)] = 0
+    np.log2(norm + 1, out=norm)
+    mean, sd = column_stats(norm)
+    _center(norm, mean, sd)
+    shift, scale = _scale_params(norm)
+    norm += shift
+    norm /= scale
+    return norm, { 'mean': mean, 'sd': sd, 'shift': shift, 'scale': scale }
+
+def extend_preprocessed(norm, stats, counts):
+    """preprocess() of old counts padded with zero rows (at the end) next to added columns counts,
+    from the preprocess_stats() results of old counts: only counts are logged, old columns are
+    re-centered from their stats, as appended zero rows change their mean and sd
+    returns normalized float matrix and its stats"""
+    counts = counts.toarray() if sp.issparse(counts) else np.asarray(counts)
+    added, astats = preprocess_stats(counts)
+    nrow, ncol = norm.shape
+    total = counts.shape[0]
+    merged = np.zeros((total, ncol + counts.shape[1]))
+    if ncol > 0:
+        # back to log values, then mean and sd with (total - nrow) zeros added
+        logs = (norm * stats['scale'] - stats['shift']) * stats['sd'] + stats['mean']
+        mean = stats['mean'] * nrow / total
+        ssq  = (nrow - 1) * stats['sd'] ** 2 + nrow * (stats['mean'] - mean) ** 2 + (total - nrow) * mean ** 2
+        sd   = np.sqrt(ssq / (total - 1)) if total > 1 else np.zeros(ncol)
+        merged[:nrow,:ncol] = logs
+        _center(merged[:,:ncol], mean, sd)
+    else:
+        mean, sd = np.zeros(0), np.zeros(0)
+    if added.size > 0:
+        # undo the scaling of the added block, it is still centered
+        merged[:,ncol:] = added * astats['scale'] - astats['shift']
+        mean = np.concatenate([mean, astats['mean']])
+        sd = np.concatenate([sd, astats['sd']])
+    shift, scale = _scale_params(merged)
+    merged += shift
+    merged /= scale
+    return merged, { 'mean': mean, 'sd': sd, 'shift': shift, 'scale': scale }
+
+def column_stats(matrix):
+    """column means and sample standard deviations, sd is 0 for a single row"""
+    mean = matrix.mean(axis=0)
+    sd = matrix.std(axis=0, ddof=1) if matrix.shape[0] > 1 else np.zeros(matrix.shape[1])
+    return mean, sd
+
+def center_columns(matrix):
+    """in place: subtract column mean, divide by column sample standard deviation
+    columns with no variance are set to 0"""
+    mean, sd = column_stats(matrix)
+    return _center(matrix, mean, sd)
+
+def scale_values(matrix):
+    """in place: add absolute minimum and divide by maximum over all values"""
+    shift, scale = _scale_params(matrix)
+    matrix += shift
+    matrix /= scale
+    return matrix
+
+def _center(matrix, mean, sd):
+    matrix -= mean
+    novar = ~(sd > 0)
+    matrix /= np.where(novar, 1, sd)
+    matrix[:,novar] = 0
+    return matrix
+
+def _scale_params(matrix):
+    shift = abs(matrix.min())
+    vmax  = matrix.max() + shift
+    return shift, (vmax if vmax > 0 else 1.0)
@@ -21,7 +21,7 @@ class Project(Collection):
          "status"         : [ 'cv',     [ ['public', 'object is public'],
         						           ['private', 'object is private'] ] ]
     """
-    def __init__(self, pid, metadata=True, stats=True, auth=None, def_name=None, cache=False, reset_cache=False):
+    def __init__(self, pid, metadata=True, stats=True, auth=None, def_name=None, cache=False, reset_cache=False, workers=1, progress=None):
         # set project
         self.cache = Ipy.NB_DIR+'/'+pid if cache else None
         project = None
@@ -63,7 +63,7 @@ class Project(Collection):
         for key, val in project.iteritems():
             setattr(self, key, val)
         # call collection init - from cache if given
-        Collection.__init__(self, self.mgids(), metadata=metadata, stats=stats, auth=auth, def_name=self.defined_name, cache=self.cache)
+        Collection.__init__(self, self.mgids(), metadata=metadata, stats=stats, auth=auth, def_name=self.defined_name, cache=self.cache, workers=workers, progress=progress)
     
     def _get_project(self, pid, metadata, auth):
         verb = 'full' if metadata else 'verbose'
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy.special import gammaln
+
+def depth_grid(nseq, points=1000, depths=None):
+    """sampling depths for a rarefaction curve of nseq sequences:
+    explicit depths if given (capped at nseq), else 0 to nseq in steps of nseq/points"""
+    if depths is not None:
+        grid = np.unique(np.asarray(depths, dtype=np.int64))
+        return grid[(grid >= 0) & (grid <= nseq)]
+    step = int(nseq / points) if nseq > points else 1
+    return np.arange(0, nseq, step, dtype=np.int64)
+
+def rarefaction_curve(counts, nseq=None, points=1000, depths=None, max_cells=4000000):
+    """expected number of annotations observed at each sampling depth, without replacement:
+        E(S_d) = sum_k ( 1 - C(nseq - n_k, d) / C(nseq, d) )
+    counts : annotation counts of one sample
+    nseq   : size of sequence pool sampled from, default is sum of counts
+    returns list of [depth, expected_richness]
+    all annotations are computed at once per block of depths, max_cells bounds the block size"""
+    counts = np.asarray(counts, dtype=float)
+    counts = counts[counts > 0]
+    if nseq is None:
+        nseq = int(counts.sum())
+    grid = depth_grid(nseq, points=points, depths=depths)
+    if (len(grid) == 0) or (len(counts) == 0):
+        return map(lambda d: [int(d), 0.0], grid)
+    # log C(nseq - n, d) / C(nseq, d) = lnG(nseq-n+1) - lnG(nseq-n-d+1) - lnG(nseq+1) + lnG(nseq-d+1)
+    remain = nseq - counts[:,None]
+    lnrem  = gammaln(remain + 1)
+    lntot  = gammaln(nseq + 1)
+    richness = np.empty(len(grid))
+    block = max(1, int(max_cells / len(counts)))
+    for b in xrange(0, len(grid), block):
+        dgrid = grid[b:b+block][None,:].astype(float)
+        left  = remain - dgrid
+        valid = left >= 0
+        with np.errstate(invalid='ignore'):
+            ratio = np.exp( np.where(valid, lnrem - gammaln(np.where(valid, left, 0) + 1) - lntot + gammaln(nseq - dgrid + 1), -np.inf) )
+        richness[b:b+block] = len(counts) - ratio.sum(axis=0)
+    return map(lambda x: [int(x[0]), float(x[1])], zip(grid, richness))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import os, time, hashlib, urllib, urlparse, threading
+from collections import OrderedDict
+
+class ResponseCache(object):
+    """Size-bounded, content-addressed on-disk cache of api responses:
+        cdir      : directory holding responses, one <sha1 of normalized url>.json file each
+        ttl       : seconds before an entry expires, None for no expiry
+        max_bytes : total byte budget, least recently used entries are evicted past it
+        counters  : hits, misses, evictions, bytes_read, bytes_written
+    """
+    def __init__(self, cdir, ttl=604800, max_bytes=1073741824):
+        self.cdir      = cdir
+        self.ttl       = ttl
+        self.max_bytes = max_bytes
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.bytes_read    = 0
+        self.bytes_written = 0
+        self._lock  = threading.Lock()
+        self._index = OrderedDict()  # key -> [size, created], oldest access first
+        self._size  = 0
+        if not os.path.isdir(self.cdir):
+            os.makedirs(self.cdir)
+        # rebuild lru order from last access times
+        entries = []
+        for fname in os.listdir(self.cdir):
+            if not fname.endswith('.json'):
+                continue
+            st = os.stat(os.path.join(self.cdir, fname))
+            entries.append((st.st_atime, fname[:-5], st.st_size, st.st_mtime))
+        for atime, key, size, created in sorted(entries):
+            self._index[key] = [size, created]
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    def key(self, url):
+        """hash of url with lower-case scheme / host and sorted query parameters"""
+        parts  = urlparse.urlsplit(url)
+        params = sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+        norm   = urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', urllib.urlencode(params), ''))
+        return hashlib.sha1(norm).hexdigest()
+
+    def get(self, url):
+        """returns cached response body for url, or None if missing or expired"""
+        key = self.key(url)
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            size, created = self._index[key]
+            if self.ttl and ((time.time() - created) > self.ttl):
+                self._remove(key)
+                self.misses += 1
+                return None
+            try:
+                body = open(self._path(key), 'rb').read()
+                os.utime(self._path(key), (time.time(), created))
+            except (IOError, OSError):
+                self._remove(key)
+                self.misses += 1
+                return None
+            # move to most recently used
+            del self._index[key]
+            self._index[key] = [size, created]
+            self.hits += 1
+            self.bytes_read += size
+            return body
+
+    def put(self, url, body):
+        """store response body for url, evicting least recently used entries if over budget"""
+        if self.max_bytes and (len(body) > self.max_bytes):
+            return
+        key = self.key(url)
+        tmp = self._path(key)+'.%d.tmp'%threading.current_thread().ident
+        with self._lock:
+            try:
+                hdl = open(tmp, 'wb')
+                hdl.write(body)
+                hdl.close()
+                os.rename(tmp, self._path(key))
+            except (IOError, OSError):
+                return
+            if key in self._index:
+                self._size -= self._index.pop(key)[0]
+            self._index[key] = [len(body), time.time()]
+            self._size += len(body)
+            self.bytes_written += len(body)
+            self._evict()
+
+    def clear(self):
+        """remove all cached responses"""
+        with self._lock:
+            for key in self._index.keys():
+                self._remove(key)
+
+    def stats(self):
+        return { 'entries': len(self._index),
+                 'bytes': self._size,
+                 'max_bytes': self.max_bytes,
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions,
+                 'bytes_read': self.bytes_read,
+                 'bytes_written': self.bytes_written }
+
+    def _path(self, key):
+        return os.path.join(self.cdir, key+'.json')
+
+    def _remove(self, key):
+        self._size -= self._index.pop(key)[0]
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.max_bytes and (self._size > self.max_bytes) and self._index:
+            self._remove(next(iter(self._index)))
+            self.evictions += 1
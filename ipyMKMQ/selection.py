@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import numpy as np
+import scipy.sparse as sp
+
+SELECT_BY = ['abundance', 'variance', 'prevalence', 'cv']
+
+def row_scores(matrix, by='abundance'):
+    """score of each row of matrix (rows x cols), numpy array or scipy sparse matrix:
+        abundance  : sum of values
+        variance   : sample variance (n-1 denominator, as R var)
+        prevalence : number of non-zero values
+        cv         : coefficient of variation, sd / mean, 0 for rows with mean 0
+    computed for all rows at once, sparse matrices are not densified"""
+    if by not in SELECT_BY:
+        raise ValueError("invalid selection '%s', use one of: %s"%(by, ", ".join(SELECT_BY)))
+    ncol = matrix.shape[1]
+    if by == 'prevalence':
+        nonzero = (matrix != 0)
+        return np.asarray(nonzero.sum(axis=1)).ravel().astype(float)
+    total = np.asarray(matrix.sum(axis=1), dtype=float).ravel()
+    if by == 'abundance':
+        return total
+    squares = matrix.multiply(matrix) if sp.issparse(matrix) else np.square(matrix, dtype=float)
+    mean = total / ncol if ncol else total
+    var  = (np.asarray(squares.sum(axis=1), dtype=float).ravel() - ncol * mean ** 2) / (ncol - 1) if ncol > 1 else np.zeros(len(total))
+    # rounding can leave tiny negative variances
+    var = np.maximum(var, 0)
+    if by == 'variance':
+        return var
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(mean != 0, np.sqrt(var) / np.abs(mean), 0)
+
+def top_rows(matrix, k, by='abundance'):
+    """indexes of the k highest scoring rows of matrix (see row_scores), highest first, ties in row order
+    the k-th score is found with a partial sort, only the k selected rows are fully sorted"""
+    scores = row_scores(matrix, by)
+    scores[np.isnan(scores)] = -np.inf
+    if k <= 0:
+        return np.zeros(0, dtype=int)
+    if k >= len(scores):
+        index = np.arange(len(scores))
+    else:
+        kth   = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth)
+        index = np.concatenate([above, np.flatnonzero(scores == kth)[:k - len(above)]])
+    return index[np.lexsort((index, -scores[index]))]
+
+def filter_rows(matrix, min_total=None, min_count=None, min_relative=None, min_samples=1):
+    """sorted indexes of rows of a count matrix (rows x cols) that pass all given filters:
+        min_total    : sum over all samples at least min_total
+        min_count    : count at least min_count in at least min_samples samples
+        min_relative : relative abundance (fraction of the sample total) at least min_relative
+                       in at least min_samples samples
+    computed for all rows at once, sparse matrices are not densified"""
+    keep = np.ones(matrix.shape[0], dtype=bool)
+    if min_total is not None:
+        keep &= np.asarray(matrix.sum(axis=1), dtype=float).ravel() >= min_total
+    if (min_count is not None) and (min_count > 0):
+        keep &= _samples_at_least(matrix, min_count) >= min_samples
+    if (min_relative is not None) and (min_relative > 0):
+        totals = np.asarray(matrix.sum(axis=0), dtype=float).ravel()
+        keep &= _samples_at_least(matrix, min_relative, np.where(totals > 0, totals, 1)) >= min_samples
+    return np.flatnonzero(keep)
+
+def _samples_at_least(matrix, threshold, scale=None):
+    # per row number of values (divided by column scale) >= threshold > 0, zeros never count
+    if sp.issparse(matrix):
+        csr = sp.csr_matrix(matrix)
+        values = csr.data / scale[csr.indices] if scale is not None else csr.data
+        hits = sp.csr_matrix(((values >= threshold).astype(int), csr.indices, csr.indptr), shape=csr.shape)
+        return np.asarray(hits.sum(axis=1)).ravel()
+    values = np.asarray(matrix, dtype=float)
+    if scale is not None:
+        values = values / scale
+    return (values >= threshold).sum(axis=1)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+import numpy as np
+import scipy.sparse as sp
+from scipy import stats
+from scipy.special import comb
+from operator import truediv
+
+# sig_test options of R/do_stats.r
+TESTS = ['t-test-paired', 'Wilcoxon-paired', 't-test-un-paired', 'Mann-Whitney_un-paired-Wilcoxon', 'ANOVA-one-way', 'Kruskal-Wallis']
+TWO_GROUP_TESTS = TESTS[:4]
+
+def group_test(matrix, groups, test='Kruskal-Wallis', exact_max=None):
+    """Python version of MGRAST_do_stats (R/do_stats.r): one significance test per row of matrix,
+    computed for all rows at once.
+        matrix : rows x cols, numpy array or scipy sparse matrix
+        groups : group label of each column, None to leave the column out
+        test   : one of TESTS, two group tests pair samples in column order
+        exact_max : wilcoxon tests use the normal approximation for groups of at least
+                    exact_max samples, default None is exact p-values at any size
+                    without ties, as do_stats.r wilcox.test(exact=TRUE)
+    returns dict of:
+        groups    : sorted group labels
+        stddev    : rows x groups standard deviation
+        statistic : test statistic per row
+        p_value   : p-value per row, nan where the test is undefined
+        fdr       : Benjamini-Hochberg adjusted p_value
+    """
+    if test not in TESTS:
+        raise ValueError("invalid test '%s', use one of: %s"%(test, ", ".join(TESTS)))
+    if len(groups) != matrix.shape[1]:
+        raise ValueError("got %d group labels for %d columns"%(len(groups), matrix.shape[1]))
+    data   = matrix.toarray() if sp.issparse(matrix) else np.asarray(matrix)
+    data   = data.astype(float)
+    labels = sorted(set(g for g in groups if g is not None))
+    index  = [ np.array([j for j, g in enumerate(groups) if g == l]) for l in labels ]
+    if len(labels) < 2:
+        raise ValueError("at least two groups are required")
+    if (test in TWO_GROUP_TESTS) and (len(labels) != 2):
+        raise ValueError("%s requires exactly two groups, got %d"%(test, len(labels)))
+    stddev = np.column_stack([ data[:,i].std(axis=1, ddof=1) if len(i) > 1 else np.full(data.shape[0], np.nan) for i in index ])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if test == 't-test-un-paired':
+            stat, pval = _welch_t(data[:,index[0]], data[:,index[1]])
+        elif test == 't-test-paired':
+            stat, pval = _paired_t(*_pairs(data, index))
+        elif test == 'Mann-Whitney_un-paired-Wilcoxon':
+            stat, pval = _rank_sum(data[:,index[0]], data[:,index[1]], exact_max)
+        elif test == 'Wilcoxon-paired':
+            stat, pval = _signed_rank(*(_pairs(data, index)+(exact_max,)))
+        elif test == 'ANOVA-one-way':
+            stat, pval = _anova(data, index)
+        else:
+            stat, pval = _kruskal(data, index)
+    return { 'groups': labels,
+             'stddev': stddev,
+             'statistic': stat,
+             'p_value': pval,
+             'fdr': bh_fdr(pval) }
+
+def bh_fdr(pvalues):
+    """Benjamini-Hochberg adjusted p-values, as R p.adjust(method='BH'), nan values are left out"""
+    pvalues = np.asarray(pvalues, dtype=float)
+    adjusted = np.empty(len(pvalues))
+    adjusted.fill(np.nan)
+    valid = np.flatnonzero(~np.isnan(pvalues))
+    if len(valid) == 0:
+        return adjusted
+    order = valid[np.argsort(pvalues[valid])[::-1]]
+    n = len(valid)
+    scaled = pvalues[order] * n / np.arange(n, 0, -1)
+    adjusted[order] = np.minimum(np.minimum.accumulate(scaled), 1)
+    return adjusted
+
+def rank_rows(data):
+    """average ranks of values within each row (ties get mean rank), 1-based
+    returns ranks and per row tie correction sum(t^3 - t) over tie group sizes t"""
+    nrow, ncol = data.shape
+    order  = np.argsort(data, axis=1, kind='mergesort')
+    values = data[np.arange(nrow)[:,None], order]
+    # tie groups numbered across the whole matrix
+    starts = np.ones(data.shape, dtype=bool)
+    starts[:,1:] = values[:,1:] != values[:,:-1]
+    group = np.cumsum(starts.ravel()) - 1
+    pos   = np.tile(np.arange(1, ncol+1, dtype=float), nrow)
+    size  = np.bincount(group)
+    mean  = np.bincount(group, weights=pos) / size
+    ranks = np.empty(data.shape)
+    ranks[np.arange(nrow)[:,None], order] = mean[group].reshape(data.shape)
+    first = np.flatnonzero(starts.ravel())
+    ties  = np.bincount(first // ncol, weights=size ** 3.0 - size, minlength=nrow)
+    return ranks, ties
+
+def _pairs(data, index):
+    if len(index[0]) != len(index[1]):
+        raise ValueError("paired tests require groups of equal size, got %d and %d"%(len(index[0]), len(index[1])))
+    return data[:,index[0]], data[:,index[1]]
+
+def _welch_t(x, y):
+    nx, ny = x.shape[1], y.shape[1]
+    vx, vy = x.var(axis=1, ddof=1) / nx, y.var(axis=1, ddof=1) / ny
+    stat = (x.mean(axis=1) - y.mean(axis=1)) / np.sqrt(vx + vy)
+    df = (vx + vy) ** 2 / (vx ** 2 / (nx - 1) + vy ** 2 / (ny - 1))
+    return stat, 2 * stats.t.sf(np.abs(stat), df)
+
+def _paired_t(x, y):
+    diff = x - y
+    n = diff.shape[1]
+    stat = diff.mean(axis=1) / (diff.std(axis=1, ddof=1) / np.sqrt(n))
+    return stat, 2 * stats.t.sf(np.abs(stat), n - 1)
+
+def _rank_sum(x, y, exact_max=None):
+    # R wilcox.test: W = rank sum of x - nx(nx+1)/2, exact without ties, else normal with continuity correction
+    nx, ny = x.shape[1], y.shape[1]
+    ranks, ties = rank_rows(np.hstack([x, y]))
+    stat = ranks[:,:nx].sum(axis=1) - nx * (nx + 1) / 2.0
+    mean = nx * ny / 2.0
+    sigma = np.sqrt((nx * ny / 12.0) * ((nx + ny + 1) - ties / ((nx + ny) * (nx + ny - 1))))
+    pval = _normal_p(stat - mean, sigma)
+    exact = ties == 0
+    if ((exact_max is None) or ((nx < exact_max) and (ny < exact_max))) and exact.any():
+        pval[exact] = _exact_p(stat[exact], mean, _rank_sum_cdf(nx, ny))
+    return stat, pval
+
+def _signed_rank(x, y, exact_max=None):
+    # R wilcox.test paired: V = sum of ranks of |d| for positive d, zero differences dropped
+    diff  = x - y
+    zeros = (diff == 0).sum(axis=1)
+    n     = diff.shape[1] - zeros
+    # zeros rank first as one tie group, shift them out of the ranks and tie correction
+    ranks, ties = rank_rows(np.abs(diff))
+    ranks -= zeros[:,None]
+    ties  -= zeros ** 3.0 - zeros
+    stat  = np.where(diff > 0, ranks, 0).sum(axis=1)
+    mean  = n * (n + 1) / 4.0
+    sigma = np.sqrt(n * (n + 1) * (2 * n + 1) / 24.0 - ties / 48.0)
+    pval  = _normal_p(stat - mean, sigma)
+    exact = (ties == 0) & (zeros == 0) & (n > 0)
+    if ((exact_max is None) or (diff.shape[1] < exact_max)) and exact.any():
+        pval[exact] = _exact_p(stat[exact], mean[exact], _signed_rank_cdf(diff.shape[1]))
+    return stat, pval
+
+def _anova(data, index):
+    k = len(index)
+    n = sum(len(i) for i in index)
+    sub   = data[:,np.concatenate(index)]
+    grand = sub.mean(axis=1)
+    ssb = sum( len(i) * (data[:,i].mean(axis=1) - grand) ** 2 for i in index )
+    ssw = sum( ((data[:,i] - data[:,i].mean(axis=1)[:,None]) ** 2).sum(axis=1) for i in index )
+    stat = (ssb / (k - 1)) / (ssw / (n - k))
+    return stat, stats.f.sf(stat, k - 1, n - k)
+
+def _kruskal(data, index):
+    k = len(index)
+    cols = np.concatenate(index)
+    n = len(cols)
+    ranks, ties = rank_rows(data[:,cols])
+    start = np.cumsum([0] + [len(i) for i in index])
+    ssr = sum( ranks[:,start[g]:start[g+1]].sum(axis=1) ** 2 / len(index[g]) for g in range(k) )
+    stat = (12.0 / (n * (n + 1)) * ssr - 3 * (n + 1)) / (1 - ties / (n ** 3 - n))
+    return stat, stats.chi2.sf(stat, k - 1)
+
+def _normal_p(diff, sigma):
+    z = (diff - np.sign(diff) * 0.5) / sigma
+    return 2 * stats.norm.sf(np.abs(z))
+
+def _exact_p(stat, mean, cdf):
+    # two-sided as R: 2 * P(S >= s) above the mean, 2 * P(S <= s) below it
+    stat  = np.rint(stat).astype(int)
+    upper = stat > mean
+    pval  = np.where(upper, 1 - cdf[np.maximum(stat - 1, 0)], cdf[np.minimum(stat, len(cdf) - 1)])
+    return np.minimum(2 * pval, 1)
+
+def _rank_sum_cdf(m, n):
+    # counts of rank sum statistics: prod (1 - q^(n+i)) / (1 - q^i), i = 1..m
+    # the subtraction cancels, counts are exact integers: floats while the number of
+    # rankings fits their mantissa, python longs beyond
+    total = comb(m + n, m, exact=True)
+    exact = total < 2 ** 53
+    counts = np.zeros(m * n + 1, dtype=float if exact else object)
+    counts[0] = 1
+    for i in range(1, m + 1):
+        counts[n+i:] -= counts[:-(n+i)].copy() if n + i <= m * n else 0
+        # division by (1 - q^i): running sums over every i-th count
+        for r in range(i):
+            counts[r::i] = np.cumsum(counts[r::i])
+    if exact:
+        return np.cumsum(counts) / total
+    return np.array([ truediv(c, total) for c in np.cumsum(counts) ])
+
+def _signed_rank_cdf(n):
+    # counts of signed rank statistics: prod (1 + q^i), i = 1..n, halved every step to stay
+    # probabilities, the counts of large samples overflow floats
+    counts = np.zeros(n * (n + 1) // 2 + 1)
+    counts[0] = 1
+    for i in range(1, n + 1):
+        counts[i:] = counts[i:] + counts[:-i].copy()
+        counts /= 2
+    return np.cumsum(counts)
@@ -0,0 +1,42 @@
+# writes r_output.json: outputs of R/preprocessing.r and R/dendrogram.r run by R, for the
+# matrix and methods of r_transcription.json. test_r_ports.py checks against it when present.
+# run from the tests dir: Rscript r_output.r  (needs ecodist and jsonlite)
+suppressPackageStartupMessages(library(jsonlite))
+source("../R/preprocessing.r")
+source("../R/dendrogram.r")
+
+counts <- matrix(c(120, 85, 3, 40,
+                   7, 0, 15, 2,
+                   300, 410, 96, 150,
+                   0, 12, 44, 9,
+                   55, 61, 0, 23,
+                   18, 25, 31, 0,
+                   240, 190, 72, 260), ncol=4, byrow=TRUE,
+                 dimnames=list(paste0("r", 1:7), paste0("mgm", 1:4)))
+raw_file  <- tempfile()
+norm_file <- tempfile()
+write.table(counts, file=raw_file, sep="\t", col.names=NA, quote=FALSE)
+MGRAST_preprocessing(file_in=raw_file, file_out=norm_file)
+norm <- data.matrix(read.table(norm_file, row.names=1, header=TRUE, sep="\t"))
+
+read_clust <- function(fname) {
+    # order, labels, then merge and height table
+    lines <- readLines(fname)
+    merge <- read.table(fname, skip=2, sep="\t")
+    list(order=as.integer(strsplit(lines[1], ",")[[1]]),
+         merge=unname(lapply(seq_len(nrow(merge)), function(i) c(merge[i,1], merge[i,2], merge[i,3]))))
+}
+dendrograms <- list()
+for (dist in c("bray-curtis", "euclidean")) {
+    for (clust in c("ward", "single", "complete", "average", "mcquitty", "median", "centroid")) {
+        col_file <- tempfile()
+        row_file <- tempfile()
+        MGRAST_dendrograms(file_in=norm_file, file_out_column=col_file, file_out_row=row_file, dist_method=dist, clust_method=clust)
+        cols <- read_clust(col_file)
+        rows <- read_clust(row_file)
+        dendrograms[[length(dendrograms)+1]] <- list(dist=dist, clust=clust, rowindex=rows$order, colindex=cols$order,
+                                                    rowdend=rows$merge, coldend=cols$merge)
+    }
+}
+write_json(list(counts=unname(counts), preprocessed=unname(norm), dendrograms=dendrograms),
+           "r_output.json", auto_unbox=TRUE, digits=NA, pretty=TRUE)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Line by line Python transcription of R/preprocessing.r, R/dendrogram.r and the R stats
+hclust Fortran (HCLUST, HCASS2), written independently of ipyMKMQ.preprocessing and ipyMKMQ.cluster.
+It is not R output: R/dendrogram.r results from R itself are checked with r_output.r.
+Writes r_transcription.json, run from the tests dir:
+    python r_transcription.py
+"""
+
+import math, json
+
+INF = 1e300
+# hclust.f iOpt codes, R maps 'ward' to ward.D
+IOPT = {'ward': 1, 'single': 2, 'complete': 3, 'average': 4, 'mcquitty': 5, 'median': 6, 'centroid': 7}
+
+def r_preprocess(x):
+    """MGRAST_preprocessing values of count rows x"""
+    n, m = len(x), len(x[0])
+    log2 = [[math.log(x[j][i] + 1, 2) for i in range(m)] for j in range(n)]
+    out = [[0.0]*m for _ in range(n)]
+    for i in range(m):
+        col = [log2[j][i] for j in range(n)]
+        mean = sum(col)/n
+        sd = math.sqrt(sum((v-mean)**2 for v in col)/(n-1))
+        for j in range(n):
+            out[j][i] = (log2[j][i]-mean)/sd
+    mn = min(min(r) for r in out)
+    for i in range(m):
+        for j in range(n):
+            out[j][i] = out[j][i] + abs(mn)
+    mx = max(max(r) for r in out)
+    for i in range(m):
+        for j in range(n):
+            if out[j][i] != 0:
+                out[j][i] = out[j][i]/mx
+    return out
+
+def r_dist(x, method):
+    """{(i, j): distance} of rows i < j of x, 1-based, R dist() euclidean / ecodist bray-curtis"""
+    n = len(x); d = {}
+    for i in range(n):
+        for j in range(i+1, n):
+            if method == 'euclidean':
+                v = math.sqrt(sum((a-b)**2 for a, b in zip(x[i], x[j])))
+            elif method == 'bray-curtis':
+                v = sum(abs(a-b) for a, b in zip(x[i], x[j])) / sum(a+b for a, b in zip(x[i], x[j]))
+            d[(i+1, j+1)] = v
+    return d
+
+def r_hclust(diss, n, method):
+    """HCLUST nearest neighbour list agglomeration, returns HCASS2 (order, merge) and heights"""
+    iopt = IOPT[method]
+    diss = dict(diss)
+    D = lambda a, b: (min(a, b), max(a, b))
+    membr = dict((i, 1.0) for i in range(1, n+1))
+    flag = dict((i, True) for i in range(1, n+1))
+    nn, disnn = {}, {}
+    ia, ib, crit = {}, {}, {}
+    for i in range(1, n):
+        dmin = INF
+        for j in range(i+1, n+1):
+            if dmin > diss[(i, j)]:
+                dmin = diss[(i, j)]; jm = j
+        nn[i] = jm; disnn[i] = dmin
+    ncl = n
+    while ncl > 1:
+        dmin = INF
+        for i in range(1, n):
+            if flag[i] and disnn[i] < dmin:
+                dmin = disnn[i]; im = i; jm = nn[i]
+        ncl -= 1
+        i2, j2 = min(im, jm), max(im, jm)
+        ia[n-ncl] = i2; ib[n-ncl] = j2; crit[n-ncl] = dmin
+        flag[j2] = False
+        dmin = INF
+        for k in range(1, n+1):
+            if flag[k] and k != i2:
+                ind1, ind2 = D(i2, k), D(j2, k)
+                xx = diss[(i2, j2)]
+                if iopt == 1:
+                    diss[ind1] = ((membr[i2]+membr[k])*diss[ind1] + (membr[j2]+membr[k])*diss[ind2] - membr[k]*xx) / (membr[i2]+membr[j2]+membr[k])
+                if iopt == 2: diss[ind1] = min(diss[ind1], diss[ind2])
+                if iopt == 3: diss[ind1] = max(diss[ind1], diss[ind2])
+                if iopt == 4: diss[ind1] = (membr[i2]*diss[ind1]+membr[j2]*diss[ind2])/(membr[i2]+membr[j2])
+                if iopt == 5: diss[ind1] = (diss[ind1]+diss[ind2])/2
+                if iopt == 6: diss[ind1] = ((diss[ind1]+diss[ind2]) - xx/2)/2
+                if iopt == 7:
+                    diss[ind1] = (membr[i2]*diss[ind1]+membr[j2]*diss[ind2] - membr[i2]*membr[j2]*xx/(membr[i2]+membr[j2]))/(membr[i2]+membr[j2])
+                if i2 < k:
+                    if diss[ind1] < dmin:
+                        dmin = diss[ind1]; jj = k
+                else:
+                    if diss[ind1] < disnn[k]:
+                        disnn[k] = diss[ind1]; nn[k] = i2
+        membr[i2] += membr[j2]
+        disnn[i2] = dmin; nn[i2] = jj
+        for i in range(1, n):
+            if flag[i] and (nn[i] == i2 or nn[i] == j2):
+                dmin = INF
+                for j in range(i+1, n+1):
+                    if flag[j] and diss[(i, j)] < dmin:
+                        dmin = diss[(i, j)]; jj = j
+                nn[i] = jj; disnn[i] = dmin
+    return hcass2(n, ia, ib), [crit[i] for i in range(1, n)]
+
+def hcass2(n, ia, ib):
+    """R merge rows and order from the HCLUST agglomerations"""
+    iia, iib = dict(ia), dict(ib)
+    for i in range(1, n-1):
+        k = min(ia[i], ib[i])
+        for j in range(i+1, n):
+            if ia[j] == k: iia[j] = -i
+            if ib[j] == k: iib[j] = -i
+    for i in range(1, n):
+        iia[i] = -iia[i]; iib[i] = -iib[i]
+    for i in range(1, n):
+        if iia[i] > 0 and iib[i] < 0:
+            iia[i], iib[i] = iib[i], iia[i]
+        if iia[i] > 0 and iib[i] > 0:
+            iia[i], iib[i] = min(iia[i], iib[i]), max(iia[i], iib[i])
+    order = [iia[n-1], iib[n-1]]
+    for i in range(n-2, 0, -1):
+        for j in range(len(order)):
+            if order[j] == i:
+                order[j:j+1] = [iia[i], iib[i]]
+                break
+    merge = [[iia[i], iib[i]] for i in range(1, n)]
+    return [-o for o in order], merge
+
+def r_dendrograms(x, dist, clust):
+    """MGRAST_dendrograms outputs, columns are clustered from the rotated matrix as the R script does"""
+    n, m = len(x), len(x[0])
+    (rord, rmerge), rh = r_hclust(r_dist(x, dist), n, clust)
+    rot = [[x[j][i] for j in range(n-1, -1, -1)] for i in range(m)]
+    (cord, cmerge), ch = r_hclust(r_dist(rot, dist), m, clust)
+    return {'rowindex': rord, 'rowdend': [a+[h] for a, h in zip(rmerge, rh)],
+            'colindex': cord[::-1], 'coldend': [a+[h] for a, h in zip(cmerge, ch)]}
+
+COUNTS = [[120, 85, 3, 40], [7, 0, 15, 2], [300, 410, 96, 150], [0, 12, 44, 9], [55, 61, 0, 23], [18, 25, 31, 0], [240, 190, 72, 260]]
+DISTS  = ['bray-curtis', 'euclidean']
+CLUSTS = ['ward', 'single', 'complete', 'average', 'mcquitty', 'median', 'centroid']
+
+def _rows(name, value, indent):
+    # one matrix row or merge step per line
+    pad = ' '*indent
+    return pad+json.dumps(name)+': [\n'+',\n'.join(pad+'  '+json.dumps(v) for v in value)+'\n'+pad+']'
+
+def write_fixture(fname='r_transcription.json'):
+    norm  = r_preprocess(COUNTS)
+    parts = [ '  "generated_by": "tests/r_transcription.py, a Python transcription of the R scripts, not R output"',
+              _rows('counts', COUNTS, 2),
+              _rows('preprocessed', norm, 2) ]
+    dends = []
+    for dist in DISTS:
+        for clust in CLUSTS:
+            r = r_dendrograms(norm, dist, clust)
+            fields = [ '      "dist": %s'%json.dumps(dist), '      "clust": %s'%json.dumps(clust),
+                       '      "rowindex": %s'%json.dumps(r['rowindex']), '      "colindex": %s'%json.dumps(r['colindex']),
+                       _rows('rowdend', r['rowdend'], 6), _rows('coldend', r['coldend'], 6) ]
+            dends.append('    {\n'+',\n'.join(fields)+'\n    }')
+    parts.append('  "dendrograms": [\n'+',\n'.join(dends)+'\n  ]')
+    open(fname, 'w').write('{\n'+',\n'.join(parts)+'\n}\n')
+
+if __name__ == '__main__':
+    write_fixture()
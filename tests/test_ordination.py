@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""checks of ipyMKMQ.ordination.pcoa, run from the repo root:
+    python -m unittest discover tests
+"""
+
+import unittest
+import numpy as np
+from ipyMKMQ import ordination, cluster
+
+class PcoaTest(unittest.TestCase):
+    def setUp(self):
+        self.counts = np.random.RandomState(1).poisson(5, size=(12, 30)) * np.random.RandomState(2).randint(0, 2, size=(12, 30))
+
+    def test_explained_non_euclidean(self):
+        # bray-curtis gives negative eigenvalues, they do not count in the total
+        res = ordination.pcoa(cluster.distance(self.counts, 'bray-curtis'))
+        self.assertTrue(res['explained'].sum() <= 1 + 1e-12)
+        self.assertAlmostEqual(res['explained'].sum(), 1)
+
+    def test_explained_euclidean(self):
+        res = ordination.pcoa(cluster.distance(self.counts, 'euclidean'), k=3)
+        full = ordination.pcoa(cluster.distance(self.counts, 'euclidean'))
+        np.testing.assert_allclose(res['explained'], full['explained'][:3])
+        self.assertAlmostEqual(full['explained'].sum(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""checks the Python ports of R/preprocessing.r and R/dendrogram.r, run from the repo root:
+    python -m unittest discover tests
+expected values come from r_transcription.json (a Python transcription of the R scripts,
+see r_transcription.py) and, when present, r_output.json written by R with r_output.r
+"""
+
+import os, json, unittest
+import numpy as np
+import scipy.sparse as sp
+from ipyMKMQ import preprocessing, cluster
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class PortCheck(object):
+    fixture = None
+
+    @classmethod
+    def setUpClass(cls):
+        fname = os.path.join(TEST_DIR, cls.fixture)
+        if not os.path.isfile(fname):
+            raise unittest.SkipTest("%s missing, run r_output.r under R to create it"%cls.fixture)
+        cls.ref = json.load(open(fname))
+
+    def test_preprocess(self):
+        norm = preprocessing.preprocess(np.array(self.ref['counts']))
+        np.testing.assert_allclose(norm, self.ref['preprocessed'], rtol=0, atol=1e-12)
+
+    def test_preprocess_sparse(self):
+        norm = preprocessing.preprocess(sp.csr_matrix(np.array(self.ref['counts'])))
+        np.testing.assert_allclose(norm, self.ref['preprocessed'], rtol=0, atol=1e-12)
+
+    def test_dendrograms(self):
+        matrix = np.array(self.ref['preprocessed'])
+        for exp in self.ref['dendrograms']:
+            name = "%s / %s"%(exp['dist'], exp['clust'])
+            res = cluster.dendrograms(matrix, exp['dist'], exp['clust'])
+            self.assertEqual(res['rowindex'], exp['rowindex'], name+' row order')
+            self.assertEqual(res['colindex'], exp['colindex'], name+' column order')
+            for key in ('rowdend', 'coldend'):
+                self.assertEqual([ m[:2] for m in res[key] ], [ m[:2] for m in exp[key] ], name+' '+key+' merges')
+                np.testing.assert_allclose([ m[2] for m in res[key] ], [ m[2] for m in exp[key] ], rtol=1e-9, atol=1e-12, err_msg=name+' '+key+' heights')
+
+class TranscriptionTest(PortCheck, unittest.TestCase):
+    fixture = 'r_transcription.json'
+
+class ROutputTest(PortCheck, unittest.TestCase):
+    fixture = 'r_output.json'
+
+if __name__ == '__main__':
+    unittest.main()